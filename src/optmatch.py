@@ -5,15 +5,22 @@ Author:  Luis M. Pena <dr.lu@coderazzi.net>
 Site:    www.coderazzi.net/python/optmatch
 """
 
+import array
+import bisect
+import keyword
 import os.path
 import re
 import sys
+import threading
+import types
+import weakref
 from sre_constants import error as RegularExpresionError
 
 __version__ = '0.9.2'
 
-__all__ = ['optset', 'optmatcher',
-           'OptionMatcher', 'OptionMatcherException', 'UsageException']
+__all__ = ['optset', 'optmatcher', 'register_converter', 'ListConverter',
+           'OptionMatcher', 'OptionMatcherException', 'UsageException',
+           'ParsedArguments', 'call_server', 'run_client']
 
 __copyright__ = """
 Copyright (c) Luis M. Pena <lu@coderazzi.net>  All rights reserved.
@@ -37,6 +44,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE."""
 
 _COMMA_SPLIT = re.compile('\\s*,\\s*')
+_IDENTIFIER = re.compile('[A-Za-z_][A-Za-z0-9_]*$')
 
 if sys.version_info.major == 2:
     def get_default_values(f):
@@ -45,10 +53,36 @@ if sys.version_info.major == 2:
     def get_method_name(f):
         return f.im_self.__class__.__name__
 
+    def read_input(prompt):
+        return raw_input(prompt)
+
     def get_flags_and_parameter_names(f):
         flags, first_arg = f.func_code.co_flags, hasattr(f, 'im_self')
         par_names = f.func_code.co_varnames[first_arg:f.func_code.co_argcount]
         return flags, par_names
+
+    def get_vararg_name(f):
+        return f.func_code.co_varnames[f.func_code.co_argcount]
+
+    def as_native_strings(value):
+        # JSON strings are loaded as unicode: converts them, also inside
+        #  lists and dictionaries, to str
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, dict):
+            return dict([(as_native_strings(k), as_native_strings(v))
+                         for k, v in value.items()])
+        if isinstance(value, list):
+            return [as_native_strings(each) for each in value]
+        return value
+
+    def is_identifier(name):
+        return isinstance(name, str) and bool(_IDENTIFIER.match(name))
+
+    def get_extra_parameter_names(f):
+        code, start = f.func_code, f.func_code.co_argcount
+        extra = bool(code.co_flags & 0x0004) + bool(code.co_flags & 0x0008)
+        return code.co_varnames[start:start + extra]
 else:
     def get_default_values(f):
         return f.__defaults__
@@ -56,11 +90,225 @@ else:
     def get_method_name(f):
         return f.__self__.__class__.__name__
 
+    def read_input(prompt):
+        return input(prompt)
+
     def get_flags_and_parameter_names(f):
         flags, first_arg = f.__code__.co_flags, hasattr(f, '__self__')
         par_names = f.__code__.co_varnames[first_arg:f.__code__.co_argcount]
         return flags, par_names
 
+    def get_vararg_name(f):
+        code = f.__code__
+        return code.co_varnames[code.co_argcount + code.co_kwonlyargcount]
+
+    def as_native_strings(value):
+        return value
+
+    def is_identifier(name):
+        return isinstance(name, str) and name.isidentifier()
+
+    def get_extra_parameter_names(f):
+        code = f.__code__
+        start = code.co_argcount + code.co_kwonlyargcount
+        extra = bool(code.co_flags & 0x0004) + bool(code.co_flags & 0x0008)
+        return code.co_varnames[start:start + extra]
+
+
+class ListConverter(object):
+    """Converter for options given as delimited lists, like --ids=1,2,3
+    Each element is converted with the given convert function (or the name
+    of a registered converter). If a typecode is given, the values are
+    stored in bulk into an array.array -or into a NumPy array, if use_numpy
+    is True and NumPy is available-; otherwise, a list is returned
+    """
+
+    def __init__(self, convert=None, separator=',', typecode=None,
+                 use_numpy=False):
+        if convert is None:
+            self.convert = _CONVERTERS['raw']
+        else:
+            self.convert = _find_converter(convert) or convert
+        self.separator = separator
+        self.typecode = typecode
+        self.use_numpy = use_numpy
+
+    def __call__(self, value):
+        return self.convert_values(value.split(self.separator))
+
+    def convert_values(self, values):
+        """Converts in bulk the given list of strings. If any cannot be
+        converted, a ValueError is raised with that string as argument"""
+        converted = []
+        for value in values:
+            try:
+                converted.append(self.convert(value))
+            except ValueError:
+                raise ValueError(value)
+        if not self.typecode:
+            return converted
+        numpy = self.use_numpy and _get_numpy()
+        if numpy:
+            def create(typecode, elements):
+                return numpy.array(elements, dtype=typecode)
+        else:
+            create = array.array
+        try:
+            return create(self.typecode, converted)
+        except (OverflowError, TypeError, ValueError):
+            # report the first element that cannot be stored
+            for value, element in zip(values, converted):
+                try:
+                    create(self.typecode, [element])
+                except (OverflowError, TypeError, ValueError):
+                    raise ValueError(value)
+            raise
+
+
+def _get_numpy():
+    # NumPy is optional and imported only when required
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    return numpy
+
+
+def _as_raw(value):
+    return value
+
+
+_INT_TYPECODE = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+
+# map from converter name to converter function (any callable receiving
+#  a string and returning the converted value or raising ValueError)
+_CONVERTERS = {
+    'int': int,
+    'float': float,
+    'raw': _as_raw,
+}
+
+# array typecodes used to store in bulk the values of simple converters
+_ARRAY_TYPECODES = {int: _INT_TYPECODE, float: 'd'}
+
+# compiled code of the generated parsers, see OptMatcherHandler.specialize
+_GENERATED_PARSERS = {}
+
+
+def _find_converter(spec):
+    # Returns the converter associated to the given specification: a name, a
+    # registered converter function or a ListConverter; None if not found
+    if isinstance(spec, ListConverter):
+        return spec
+    try:
+        return _CONVERTERS[spec]
+    except (KeyError, TypeError):
+        if spec in _CONVERTERS.values():
+            return spec
+
+
+def _export_converter(converter):
+    # Returns the JSON serializable specification of the given converter,
+    #  or None if it cannot be exported (it is not registered)
+    for name, each in _CONVERTERS.items():
+        if each is converter:
+            return name
+    if isinstance(converter, ListConverter):
+        convert = _export_converter(converter.convert)
+        if convert:
+            return {'convert': convert, 'separator': converter.separator,
+                    'typecode': converter.typecode,
+                    'use_numpy': converter.use_numpy}
+    return None
+
+
+def _load_converter(spec):
+    # Returns the converter given its JSON specification, see above
+    try:
+        if isinstance(spec, dict):
+            return ListConverter(_load_converter(spec['convert']),
+                                 spec['separator'], spec['typecode'],
+                                 spec['use_numpy'])
+        return _CONVERTERS[spec]
+    except (KeyError, TypeError):
+        raise OptionMatcherException('Invalid converter: ' + str(spec))
+
+
+def register_converter(name, converter):
+    """Registers a converter, a function receiving a string and returning
+    the converted value -or raising ValueError on invalid input-.
+    Registered converters can be referred by name on the 'converters'
+    decorator parameter, or used as python annotations on options
+    """
+    if not callable(converter):
+        raise OptionMatcherException('Invalid converter: ' + name)
+    _CONVERTERS[name] = converter
+
+
+register_converter('int_list', ListConverter(int, typecode=_INT_TYPECODE))
+register_converter('float_list', ListConverter(float, typecode='d'))
+register_converter('raw_list', ListConverter())
+
+
+class LazyFunction(object):
+    """Callable standing for a function given by its dotted path, like
+    'package.module:function', which is imported only when required: when
+    invoked, or when its documentation is accessed
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.__name__ = re.split('[.:]', target)[-1]
+        self._function = None
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    @property
+    def __doc__(self):
+        return self.resolve().__doc__
+
+    def resolve(self):
+        """Returns the real function, importing its module if needed"""
+        if self._function is None:
+            import importlib
+            if ':' in self.target:
+                module, attributes = self.target.split(':', 1)
+            else:
+                module, attributes = self.target.rsplit('.', 1)
+            try:
+                function = importlib.import_module(module)
+                for each in attributes.split('.'):
+                    function = getattr(function, each)
+            except (ImportError, AttributeError):
+                raise OptionMatcherException('Cannot load ' + self.target)
+            self._function = function
+        return self._function
+
+
+class _SpecFunction(object):
+    """Callable standing for the function of a matcher defined on a spec
+    -see OptionMatcher.add_spec-, named as given on the spec. It invokes
+    the spec's function, if any
+    """
+
+    def __init__(self, name, function=None, doc=None):
+        self.__name__ = name
+        self.function = function
+        self.doc = doc
+
+    def __call__(self, *args, **kwargs):
+        if self.function is None:
+            raise OptionMatcherException('No function defined for ' +
+                                         self.__name__ + ', only parsing')
+        return self.function(*args, **kwargs)
+
+    @property
+    def __doc__(self):
+        if self.doc is None:
+            return getattr(self.function, '__doc__', None)
+        return self.doc
+
 
 class Decoration(object):
     """
@@ -106,31 +354,96 @@ class Decoration(object):
         #  or (None, None, None) otherwise, where Info is the ordered list
         #  of the decorator parameters
 
+        # The returned modifiers is a map with the decorator parameters
+        #  that do not define flags/options, and can be therefore used
+        #  together with the naming convention on the parameters
         def parser(flags=None, options=None, int_options=None,
                    float_options=None, prefixes=None,  priority=None,
-                   group=None):
-            return ((flags, options, int_options, float_options, prefixes),
-                    group, priority)
+                   group=None, raw_options=None, converters=None,
+                   varargs=None, count_flags=None, multi_options=None,
+                   dict_prefixes=None, duplicates=None, command=None):
+            return ((flags, options, int_options, float_options, prefixes,
+                     raw_options, count_flags, multi_options, dict_prefixes),
+                    group, priority,
+                    {'converters': converters, 'varargs': varargs,
+                     'duplicates': duplicates, 'command': command})
 
         try:
             return parser(*func.optmatcher)
         except AttributeError:
-            return None, None, None
+            return None, None, None, {}
+
+    # Decorated attributes of each class, collected once per class as a
+    # tuple (attributes, names), where attributes are the class attributes
+    # when collected, and names a tuple (matchers, optsets), with the names
+    # of the decorated attributes, both priority sorted
+    _registry = weakref.WeakKeyDictionary()
 
     @staticmethod
     def get_decorated_methods(instance, defined_as_common):
         # Returns the methods decorated with optmatcher or optset -depending
-        # on defined_as_common, priority sorted
-        functions_and_priorities = []
-        for att in dir(instance):
-            f = getattr(instance, att)
-            if defined_as_common == hasattr(f, 'optset'):
-                info, group, priority = Decoration.parse_decoration(f)
-                if info:
-                    functions_and_priorities.append((priority or 0, f))
-        # sort now by inverse priority, and return just the functions
-        functions_and_priorities.sort(key=lambda x: -x[0])
-        return [f for (p, f) in functions_and_priorities]
+        # on defined_as_common, priority sorted, bound to the instance
+        cls = type(instance)
+        attributes = Decoration._get_class_attributes(cls)
+        try:
+            known, names = Decoration._registry[cls]
+            if not Decoration._same_attributes(known, attributes):
+                raise KeyError(cls)  # the class was modified afterwards
+        except KeyError:
+            names = Decoration._collect_decorated_attributes(attributes)
+            Decoration._registry[cls] = attributes, names
+        # the attributes set on the instance override those of its class
+        own = getattr(instance, '__dict__', None) or {}
+        decorated = set(names[0] + names[1])
+        if own and any([n in decorated or (callable(v) and hasattr(
+                        getattr(v, '__func__', v), 'optmatcher'))
+                        for n, v in own.items()]):
+            merged = dict(attributes)
+            merged.update(own)
+            names = Decoration._collect_decorated_attributes(merged)
+
+        def get(name):
+            if name in own:
+                return own[name]
+            ret = attributes[name]
+            # as getattr, but without accessing any other attribute
+            return ret.__get__(instance, cls) if hasattr(ret, '__get__') \
+                else ret
+
+        return [get(each) for each in names[bool(defined_as_common)]]
+
+    @staticmethod
+    def _get_class_attributes(cls):
+        # Walks the class hierarchy, without accessing the attributes on any
+        # instance: the attributes defined in subclasses override the ones
+        # in the base classes, even if not decorated
+        attributes = {}
+        for klass in cls.__mro__:
+            for name, value in klass.__dict__.items():
+                attributes.setdefault(name, value)
+        return attributes
+
+    @staticmethod
+    def _same_attributes(known, attributes):
+        # Returns True if both dictionaries have the same values -the same
+        # objects- under the same names
+        return len(known) == len(attributes) and \
+            all([attributes.get(name, known) is value
+                 for name, value in known.items()])
+
+    @staticmethod
+    def _collect_decorated_attributes(attributes):
+        # Returns the tuple (matchers, optsets) with the names of the
+        # decorated attributes, as get_decorated_methods
+        ret = [], []
+        # as before, sorted by name and then by inverse priority
+        for name in sorted(attributes):
+            function = getattr(attributes[name], '__func__', attributes[name])
+            info, group, priority, _ = Decoration.parse_decoration(function)
+            if info:
+                ret[hasattr(function, 'optset')].append((priority or 0, name))
+        return tuple([[n for (p, n) in sorted(each, key=lambda x: -x[0])]
+                      for each in ret])
 
 
 class UsageMode(object):
@@ -189,19 +502,30 @@ class CommandLine(object):
     #   option : Bool, true if the current argument is an option
     #   is_short: Bool, true if the current arg is a short option
 
-    def __init__(self, args, mode, gnu_mode):
-        """param args: the list of arguments to handle (first dismissed)"""
+    def __init__(self, args, mode, gnu_mode, abbreviations=None):
+        """param args: the list of arguments to handle (first dismissed)
+        param abbreviations: if given, the AbbreviationIndex to expand
+            the abbreviated long options
+        """
         # re_short is hardcoded to '-' if the option is defined as '--'
         self.re_short = mode.getopt
         self.re_option = mode.option
         self.re_separation = re.compile('(.+?)' + mode.assigner + '(.+)$')
+        self.expanded = {}  # memoized expansions, shared by all matchers
+        self.names = set()  # reused on each summarize
+        self.restart(args, gnu_mode, abbreviations)
+
+    def restart(self, args, gnu_mode, abbreviations=None):
+        """Prepares the instance to handle a new list of arguments"""
         self.args = args
         self.gnu_mode = gnu_mode
-        self.can_be_option = True  # used for gnu_mode
+        self.abbreviations = abbreviations
+        self.expanded.clear()
         self.reset()
 
     def reset(self):
         self.next = 1
+        self.can_be_option = True  # used for gnu_mode
         if len(self.args) > 1:
             self._next()
 
@@ -224,6 +548,21 @@ class CommandLine(object):
         m = self.re_separation.match(what)
         return m and (True, m.group(1), m.group(2)) or (False, what, None)
 
+    def expand(self, value):
+        """Expands the shell and user variables in the given value.
+        The result is memoized, as the same value is usually expanded by
+        each matcher trying the command line
+        """
+        if ('$' not in value and '%' not in value and
+                not value.startswith('~')):
+            return value
+        try:
+            return self.expanded[value]
+        except KeyError:
+            ret = os.path.expanduser(os.path.expandvars(value))
+            self.expanded[value] = ret
+            return ret
+
     def set_arg_handled(self):
         """Reports that the current argument has been handled.
         It returns True if there are no more arguments to handle or the
@@ -240,6 +579,28 @@ class CommandLine(object):
         else:
             self.set_arg_handled()
 
+    def handle_short_cluster(self, short_options):
+        """Handles the current short argument -like -xvf- in a single pass,
+        with the given table mapping each short name to a tuple (handler,
+        flag) where flag is the flag's index, or None for options and
+        prefixes, which are passed to the handler with the rest of the
+        argument as value. Returns None, or the reason why a short name
+        could not be handled
+        """
+        arg = self.arg
+        for i in range(len(arg) - len(self.value) - 1, len(arg)):
+            try:
+                handler, flag = short_options[arg[i]]
+            except KeyError:
+                self.name, self.value = arg[i], arg[i + 1:]
+                return 'Unexpected flag ' + self.name + ' in argument ' + arg
+            if not flag:
+                self.name, self.value = arg[i], arg[i + 1:]
+                return handler.handle_arg(self)
+            handler._set_flag(flag)
+        self.set_arg_handled()
+        return None
+
     def _next(self):
         """Handles the next argument, returning True if it is an option"""
         self.arg = self.args[self.next]
@@ -265,8 +626,47 @@ class CommandLine(object):
             self.name, self.value = arg[0], arg[1:]
         else:
             self.split, self.name, self.value = self.separate(arg)
+            if self.option and self.abbreviations:
+                self.name = self._expand_abbreviation(self.name)
         return self.option
 
+    def summarize(self):
+        """Scans quickly the arguments, without handling them, returning
+        a tuple (parameters, options, names), where parameters is the
+        maximum number of parameters, options is the number of options that
+        could take the next argument as value, and names is the set of
+        option names given -for short options, all their characters-
+        """
+        parameters, options, names = 0, 0, self.names
+        names.clear()
+        for arg in self.args[1:]:
+            if arg.startswith(self.re_option):
+                options += 1
+                name = self.separate(arg[len(self.re_option):])[1]
+                if self.abbreviations:
+                    matches = self.abbreviations.resolve(name)
+                    if len(matches) == 1:
+                        name = matches[0]
+                names.add(name)
+            elif self.re_short and arg.startswith('-'):
+                options += 1
+                names.update(arg[1:])
+            else:
+                parameters += 1
+        # options take their value as next argument only in getopt mode
+        return parameters, self.re_short and options, names
+
+    def _expand_abbreviation(self, name):
+        """Returns the long option abbreviated by the given name, or the
+        name itself if it abbreviates none. Raises an UsageException if
+        it is ambiguous"""
+        matches = self.abbreviations.resolve(name)
+        if len(matches) > 1:
+            raise UsageException('Ambiguous option %s%s: %s' % (
+                self.re_option, name,
+                ', '.join([self.re_option + m for m in matches])))
+        return matches and matches[0] or name
+
 
 class ArgumentInfo(object):
     """Class to represent arguments (options, parameters), for help matters"""
@@ -372,14 +772,18 @@ class OptMatcherInfo(object):
 
     _NON_ALPHANUM = re.compile('[^a-zA-Z0-9]')
     DECORATOR_ASSIGN = re.compile('(.+?)\\s+as\\s+(.+)')
+    DUPLICATES_POLICIES = ('first', 'last', 'error', 'collect')
     FLAG_PATTERN = re.compile('(.+)'
                               '(Flag|Option|OptionInt|OptionFloat|Prefix|'
                               '_flag|_option|_option_int|'
                               '_option_float|_prefix)$')
 
-    def __init__(self, func, mode):
+    def __init__(self, func, mode, plan_entry=None, spec=None):
         self.mode = mode
-        self._initialize_parameters_information(func)
+        if plan_entry is None:
+            self._initialize_parameters_information(func, spec)
+        else:
+            self._initialize_from_plan_entry(func, plan_entry)
 
         # With getoptmode, in addition to the normal definitions, users
         # can specify short options, stored in sorted_defs
@@ -404,14 +808,21 @@ class OptMatcherInfo(object):
             return self.short_defs
         return self.defs
 
-    def _initialize_parameters_information(self, func):
+    def _initialize_parameters_information(self, func, spec=None):
         # Initializes all parameter information associated to the function:
+        # If a spec is given (see OptionMatcher.add_spec), the parameters
+        # and default values are read from it, not from the function
         # Note that the index number associated to the first parameter
         # is 1, not zero. This simplifies later many checks
         self.flags = {}  # maps flag name to parameter index
         self.options = {}  # maps option name to parameter index
         self.prefixes = {}  # maps prefix name to parameter index
         self.converts = {}  # maps from index (option) to convert function
+        self.counters = set()  # indexes of flags counting its occurrences
+        # maps the index of options that can be repeated to the typecode of
+        #  the array storing the values, or None to store them in a list
+        self.multiples = {}
+        self.dict_prefixes = set()  # indexes of prefixes given as a dict
         # self.pars maps parameter index to parameter name - a parameter
         # is any method' variable that is not a flag, option, prefix, etc
         self.pars = {}
@@ -419,21 +830,163 @@ class OptMatcherInfo(object):
         self.orphan_flags = 0  # flags without associated variable
         self.func = func
 
-        par_names, self.vararg, kwarg = self._get_parameters_info(func)
+        if spec is None:
+            par_names, self.vararg, kwarg = self._get_parameters_info(func)
+        else:
+            par_names, self.vararg, kwarg = self._get_spec_info(spec)
+        self.par_names = par_names
         # if kwargs are supported, kwargs is used as a dictionary
         self.kwargs = kwarg and not self.mode.getopt and {}
         # note that self.group is used for 'applies' and 'exclusive'
-        decoration, self.group, priority = Decoration.parse_decoration(func)
+        decoration, self.group, priority, modifiers = \
+            Decoration.parse_decoration(func)
+        self.priority = priority or 0
+        self.is_optset = hasattr(func, 'optset')
         if decoration and any(filter(None, decoration)):
             self._initialize_parameters_from_decorator(par_names, *decoration)
         else:
             self._initialize_parameters_from_signature(par_names)
-
-            # get default values
+        self._initialize_converters(func, par_names,
+                                    modifiers.get('converters'),
+                                    modifiers.get('varargs'))
+        self.duplicates = self._get_duplicates(par_names,
+                                               modifiers.get('duplicates'))
+        self.command = self._get_command(modifiers.get('command'))
+
+        # get default values
+        if spec is not None:
+            self.defaults = self._get_spec_defaults(par_names,
+                                                    spec.get('defaults'))
+            return
         defs = list(get_default_values(func) or [])
         first_def = self.last_arg - len(defs)
         self.defaults = dict([(i + first_def, d) for i, d in enumerate(defs)])
 
+    def _get_spec_info(self, spec):
+        # Returns, as _get_parameters_info, the information of the
+        # parameters given on a spec
+        parameters = as_native_strings(spec.get('parameters') or [])
+        if isinstance(parameters, str):
+            parameters = _COMMA_SPLIT.split(parameters.strip())
+        # each parameter must be valid as the parameter of a function
+        valid = isinstance(parameters, (list, tuple))
+        for index, name in enumerate(valid and parameters or []):
+            if not is_identifier(name) or keyword.iskeyword(name) or \
+                    name in parameters[:index]:
+                valid = False
+        if not valid:
+            raise OptionMatcherException('Invalid spec for ' +
+                                         self.func.__name__)
+        return (list(parameters), bool(spec.get('vararg')),
+                bool(spec.get('kwargs')))
+
+    def _get_spec_defaults(self, par_names, defaults):
+        # Returns the default values given by name on a spec, by index
+        ret = {}
+        for name, value in (defaults or {}).items():
+            try:
+                ret[par_names.index(name) + 1] = value
+            except ValueError:
+                raise OptionMatcherException('%s: Invalid default: %s' %
+                                             (self.describe(), name))
+        return ret
+
+    def _initialize_from_plan_entry(self, func, entry):
+        # Initializes all parameter information from an entry in a plan
+        # exported as JSON: see export. The function is not inspected
+
+        def by_index(group, convert=lambda x: x):
+            return dict([(int(i), convert(v)) for i, v in group.items()])
+
+        def by_name(group):
+            return dict([(n, int(i)) for n, i in group.items()])
+
+        entry = as_native_strings(entry)
+        try:
+            self.func = func
+            self.priority = entry['priority']
+            self.is_optset = 'applies' in entry
+            if self.is_optset:
+                self.group = entry['applies'] and re.compile(entry['applies'])
+            else:
+                self.group = entry['exclusive']
+            self.par_names = list(entry['parameters'])
+            self.pars = by_index(entry['pars'])
+            self.flags = by_name(entry['flags'])
+            self.options = by_name(entry['options'])
+            self.prefixes = by_name(entry['prefixes'])
+            self.converts = by_index(entry['converters'], _load_converter)
+            self.counters = set(entry['counters'])
+            self.multiples = by_index(entry['multiples'])
+            self.dict_prefixes = set(entry['dict_prefixes'])
+            self.duplicates = by_index(entry['duplicates'])
+            self.command = self._get_command(entry.get('command'))
+            self.defaults = by_index(entry['defaults'])
+            self.last_arg = entry['last_arg']
+            self.orphan_flags = entry['orphan_flags']
+            self.vararg = entry['vararg']
+            self.vararg_convert = (entry['vararg_converter'] and
+                                   _load_converter(entry['vararg_converter']))
+            self.kwargs = entry['kwargs'] and not self.mode.getopt and {}
+        except (KeyError, AttributeError, TypeError, ValueError):
+            raise OptionMatcherException('Invalid plan entry for ' +
+                                         self.describe())
+
+    def export(self):
+        """Returns the information of this matcher as a JSON serializable
+        dictionary, used to rebuild it without inspecting the function
+        """
+        import json
+
+        def by_index(group, convert=lambda x: x):
+            return dict([(str(i), convert(v)) for i, v in group.items()])
+
+        def export_converter(converter):
+            ret = _export_converter(converter)
+            if not ret:
+                raise OptionMatcherException('%s: Cannot export converter %s'
+                                             % (self.describe(), converter))
+            return ret
+
+        for index, value in self.defaults.items():
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                raise OptionMatcherException(
+                    '%s: Cannot export default value of %s' %
+                    (self.describe(), self.get_index_name(index)))
+        ret = {'name': self.func.__name__,
+               'priority': self.priority,
+               'parameters': list(self.par_names),
+               'pars': by_index(self.pars),
+               'flags': dict(self.flags),
+               'options': dict(self.options),
+               'prefixes': dict(self.prefixes),
+               'converters': by_index(self.converts, export_converter),
+               'counters': sorted(self.counters),
+               'multiples': by_index(self.multiples),
+               'dict_prefixes': sorted(self.dict_prefixes),
+               'duplicates': by_index(self.duplicates),
+               'defaults': by_index(self.defaults),
+               'last_arg': self.last_arg,
+               'orphan_flags': self.orphan_flags,
+               'vararg': bool(self.vararg),
+               'vararg_converter': (self.vararg_convert and
+                                    export_converter(self.vararg_convert)),
+               'kwargs': self.supports_k_w_args()}
+        if isinstance(self.func, LazyFunction):
+            ret['target'] = self.func.target
+        elif isinstance(self.func, _SpecFunction) and \
+                isinstance(self.func.function, LazyFunction):
+            ret['target'] = self.func.function.target
+        if self.command:
+            ret['command'] = list(self.command)
+        if self.is_optset:
+            ret['applies'] = self.group and self.group.pattern
+        else:
+            ret['exclusive'] = bool(self.group)
+        return ret
+
     def _initialize_parameters_from_signature(self, par_names):
         # Initializes the metadata from the function's parameter names
 
@@ -462,9 +1015,9 @@ class OptMatcherInfo(object):
                 else:
                     goes = self.options
                     if what in ['OptionInt', '_option_int']:
-                        self.converts[self.last_arg] = self._as_int
+                        self.converts[self.last_arg] = _CONVERTERS['int']
                     elif what in ['OptionFloat', '_option_float']:
-                        self.converts[self.last_arg] = self._as_float
+                        self.converts[self.last_arg] = _CONVERTERS['float']
                 if use_name in used:
                     raise OptionMatcherException(
                         '%s: Invalid parameter reuse: %s' %
@@ -477,15 +1030,21 @@ class OptMatcherInfo(object):
 
     def _initialize_parameters_from_decorator(self, par_names, flags, options,
                                               int_options, float_options,
-                                              prefixes):
+                                              prefixes, raw_options,
+                                              count_flags, multi_options,
+                                              dict_prefixes):
 
         def get_decoration_definitions(decoration):
             # The returned value maps names to 'as' values, if present, or to
-            #  None, otherwise, for a given decoration argument
+            #  None, otherwise, for a given decoration argument, given as a
+            #  comma separated string, or as a list (see add_spec)
             ret = {}
             if decoration:
                 try:
-                    defs = _COMMA_SPLIT.split(decoration.strip())
+                    if isinstance(decoration, (list, tuple)):
+                        defs = [each.strip() for each in decoration]
+                    else:
+                        defs = _COMMA_SPLIT.split(decoration.strip())
                 except (AttributeError, TypeError):
                     raise OptionMatcherException('Invalid definition')
                 for d in defs:
@@ -503,12 +1062,18 @@ class OptMatcherInfo(object):
         # It also enables the usage of reserved words: a flag 'import' could
         # be associated to a variable import_', for example
         par_names = [self._NON_ALPHANUM.sub('', v) for v in par_names]
-        ints, floats, used = {}, {}, set()
+        ints, floats, raws, used = {}, {}, {}, set()
+        indexes = set()  # indexes of the parameters defined as flags, etc
+        counts, multis, dicts = {}, {}, {}
         for att, group in [(self.flags, flags),
                            (self.options, options),
                            (self.prefixes, prefixes),
                            (ints, int_options),
-                           (floats, float_options)]:
+                           (floats, float_options),
+                           (raws, raw_options),
+                           (counts, count_flags),
+                           (multis, multi_options),
+                           (dicts, dict_prefixes)]:
             # in the following loop, n defines each parameter name given
             # in the decorator for each group (flags, options, etc), while
             # v defines the public name (n as v)
@@ -533,19 +1098,126 @@ class OptMatcherInfo(object):
                         '%s: Invalid parameter reuse: %s' %
                         (self.describe(), name))
                 used.add(par)
+                indexes.add(1 + index)
                 att[par] = 1 + index
 
         # all groups are created as maps (name -> variable index), but for
         # params we invert the map, as the index is the important information
         self.pars = dict([(i + 1, v) for i, v in enumerate(par_names)
-                          if i not in used])
-        # int_options and float_options are options with additional checks:
+                          if i + 1 not in indexes])
+        # int_options and float_options are options with additional checks,
+        # raw_options are options whose values are not expanded
         self.options.update(ints)
         self.options.update(floats)
-        self.converts = dict([(i, self._as_float) for i in floats.values()])
-        self.converts.update(dict([(i, self._as_int) for i in ints.values()]))
+        self.options.update(raws)
+        # count_flags are flags, and multi_options are options, that can be
+        # provided multiple times
+        self.flags.update(counts)
+        self.options.update(multis)
+        self.counters = set(counts.values())
+        self.multiples = dict.fromkeys(multis.values())
+        # dict_prefixes are prefixes whose values are given as a dictionary
+        self.prefixes.update(dicts)
+        self.dict_prefixes = set(dicts.values())
+        for group, name in (floats, 'float'), (ints, 'int'), (raws, 'raw'):
+            for index in group.values():
+                self.converts[index] = _CONVERTERS[name]
         self.last_arg = len(par_names) + 1
 
+    def _initialize_converters(self, func, par_names, converters, varargs):
+        # Sets the converters defined on the 'converters' decorator parameter
+        # (a map from parameter name to converter) or, for options without
+        # explicit conversion, as python 3 annotations. The same applies to
+        # the *args parameter, using the 'varargs' decorator parameter
+        annotations = getattr(func, '__annotations__', None) or {}
+        self.vararg_convert = None
+        if varargs is not None:
+            if not self.vararg:
+                raise OptionMatcherException('%s: Invalid varargs converter'
+                                             % self.describe())
+            self.vararg_convert = self._get_converter(varargs)
+        elif self.vararg and annotations:
+            self.vararg_convert = _find_converter(
+                annotations.get(get_vararg_name(func)))
+        if self.vararg_convert and not isinstance(self.vararg_convert,
+                                                  ListConverter):
+            # varargs are always converted in bulk, into arrays if possible
+            self.vararg_convert = ListConverter(
+                self.vararg_convert,
+                typecode=_ARRAY_TYPECODES.get(self.vararg_convert))
+        indexes = dict([(self._NON_ALPHANUM.sub('', v), i + 1)
+                        for i, v in enumerate(par_names)])
+        options = set(self.options.values())
+        for name, spec in (converters or {}).items():
+            index = indexes.get(self._NON_ALPHANUM.sub('', name))
+            if index not in options:
+                raise OptionMatcherException('%s: Invalid converter target: %s'
+                                             % (self.describe(), name))
+            self.converts[index] = self._get_converter(spec)
+        for i, name in enumerate(par_names):
+            index = i + 1
+            if (index in options and index not in self.converts
+                    and name in annotations):
+                converter = _find_converter(annotations[name])
+                if converter:
+                    self.converts[index] = converter
+        for index in self.multiples:
+            self.multiples[index] = _ARRAY_TYPECODES.get(
+                self.converts.get(index))
+
+    def _get_duplicates(self, par_names, duplicates):
+        # Returns the duplicates policy of each dict prefix, by index, given
+        #  the 'duplicates' decorator parameter: a policy for all the dict
+        #  prefixes, or a dictionary with the policy of each one, by name
+        ret = dict.fromkeys(self.dict_prefixes, 'last')
+        if duplicates is None:
+            return ret
+        if not self.dict_prefixes:
+            raise OptionMatcherException('%s: Duplicates policy without '
+                                         'dict_prefixes' % self.describe())
+        if isinstance(duplicates, dict):
+            indexes = dict([(self._NON_ALPHANUM.sub('', v), i + 1)
+                            for i, v in enumerate(par_names)])
+            for name, policy in duplicates.items():
+                index = indexes.get(self._NON_ALPHANUM.sub('', name))
+                if index not in self.dict_prefixes:
+                    raise OptionMatcherException(
+                        '%s: Invalid duplicates target: %s' %
+                        (self.describe(), name))
+                ret[index] = policy
+        else:
+            ret = dict.fromkeys(self.dict_prefixes, duplicates)
+        for policy in ret.values():
+            if policy not in self.DUPLICATES_POLICIES:
+                raise OptionMatcherException(
+                    '%s: Invalid duplicates policy: %s' %
+                    (self.describe(), policy))
+        return ret
+
+    def _get_command(self, command):
+        # Returns the subcommand words -given as a list, or as a string
+        #  separated by spaces-, as a tuple, which is empty if not defined
+        if isinstance(command, str):
+            command = command.split()
+        ret = tuple(command or ())
+        for word in ret:
+            if not word or word.startswith(self.mode.option) or \
+                    (self.mode.getopt and word.startswith('-')):
+                raise OptionMatcherException('%s: Invalid command: %s' %
+                                             (self.describe(), word))
+        return ret
+
+    def _get_converter(self, spec):
+        # Returns the converter for the given specification, raising an
+        #  exception if it is not a valid one
+        ret = _find_converter(spec)
+        if not ret:
+            if not callable(spec):
+                raise OptionMatcherException('%s: Invalid converter: %s'
+                                             % (self.describe(), spec))
+            ret = spec
+        return ret
+
     def applies_to_matcher(self, matcher_handler):
         """Returns true if this 'optset' handler applies to the matcher"""
         if not self.group:  # the user didn't specify an 'applies'
@@ -671,11 +1343,33 @@ class OptMatcherInfo(object):
         flags, var_names = get_flags_and_parameter_names(f)
         return list(var_names), (flags & 0x0004) != 0, (flags & 0x0008) != 0
 
-    def _as_int(self, value):
-        return int(value)
 
-    def _as_float(self, value):
-        return float(value)
+class ParsedArguments(object):
+    """Base class of the results returned by OptionMatcher.parse.
+    A subclass is created for each matcher, named as its function, with a
+    slot for each parameter of the function -including *args and **kwargs-
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def as_dict(self):
+        """Returns the values as a dictionary, by parameter name"""
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            ['%s=%r' % (name, getattr(self, name))
+             for name in self.__slots__]))
 
 
 class OptMatcherHandler(OptMatcherInfo):
@@ -683,14 +1377,48 @@ class OptMatcherHandler(OptMatcherInfo):
     It is an OptMatcherInfo extended with operations to handle arguments
     """
 
-    def __init__(self, func, mode):
-        OptMatcherInfo.__init__(self, func, mode)
+    def __init__(self, func, mode, plan_entry=None, spec=None):
+        OptMatcherInfo.__init__(self, func, mode, plan_entry, spec)
+        # The provided values are stored in a list indexed by parameter
+        # index -orphan flags, with negative indexes, at the end-, and
+        # the bit (1 << index % slots) of provided_mask is set for each
+        # parameter provided
+        self.slots = self.last_arg - self.orphan_flags
+        self.provided = [None] * self.slots
+        self.prefixes_mask = self._get_mask(self.prefixes.values())
+        self.orphans_mask = self._get_mask(range(self.orphan_flags, 0))
+        # if pooled, the containers are cleared on reset, not created again
+        self.pooled = False
+        self._result_class = None  # see get_result_class
         self.reset()
 
+    def _get_mask(self, indexes):
+        # Returns the mask with the bits of the given parameter indexes
+        ret = 0
+        for each in indexes:
+            ret |= 1 << each % self.slots
+        return ret
+
     def reset(self):
-        # all prefixes are reset as provided as an empty list
-        self.provided = dict([(i, []) for i in self.prefixes.values()])
+        # all prefixes are reset as an empty list (or dict), although they
+        # are not flagged as provided until a value is added
+        self.provided_mask = 0
+        self.converted_vararg = None
+        if self.pooled:
+            for i in self.prefixes.values():
+                if i in self.dict_prefixes:
+                    self.provided[i].clear()
+                else:
+                    del self.provided[i][:]
+            del self.provided_pars[:]
+            if self.supports_k_w_args():
+                self.kwargs.clear()
+            return
+        for i in self.prefixes.values():
+            self.provided[i] = {} if i in self.dict_prefixes else []
         self.provided_pars = []
+        if self.supports_k_w_args():
+            self.kwargs = {}
 
     def invoke(self):
         """Invokes the underlying function, unless it cannot be invoked."""
@@ -698,28 +1426,71 @@ class OptMatcherHandler(OptMatcherInfo):
         status, args, kwargs = self._get_invoking_pars()
         return (status is None) and self.func(*args, **kwargs)
 
+    def get_result(self):
+        """Returns the values that would be used to invoke the underlying
+        function, as an instance of its result class, if it can be invoked.
+        The function is not invoked"""
+        status, args, kwargs = self._get_invoking_pars()
+        if status is not None:
+            return None
+        values = args[:self.last_arg - 1]
+        if self.vararg_convert and self.vararg_convert.typecode:
+            # the array converted in bulk, instead of its unpacked values
+            values.append(self.converted_vararg[1])
+        elif self.vararg:
+            values.append(tuple(args[self.last_arg - 1:]))
+        if self.supports_k_w_args():
+            values.append(dict(kwargs))
+        return self.get_result_class()(*values)
+
+    def get_result_class(self):
+        """Returns the ParsedArguments subclass for this handler, created
+        only once"""
+        if not self._result_class:
+            try:
+                extra = list(get_extra_parameter_names(self.func))
+            except AttributeError:  # not inspectable, like lazy functions
+                extra = ['args', 'kwargs']
+            names = list(self.par_names)
+            if self.vararg:
+                names.append(extra[0])
+            if self.supports_k_w_args():
+                names.append(extra[-1])
+            # each name becomes a slot: private names would be mangled
+            for name in names:
+                if not is_identifier(name) or name.startswith('__'):
+                    raise OptionMatcherException(
+                        '%s: Invalid parameter name: %s' %
+                        (self.describe(), name))
+            if len(set(names)) < len(names):
+                raise OptionMatcherException(
+                    '%s: Duplicated parameter names' % self.describe())
+            self._result_class = type(str(self.func.__name__),
+                                      (ParsedArguments,),
+                                      {'__slots__': tuple(names)})
+        return self._result_class
+
     def check_invokable(self, required):
         """Verifies whether the underlying function can be invoked."""
 
-        def something_provided():
-            # just check if the user provided any value.
-            return self.provided_pars or any(filter(lambda x: x != [],
-                                                    self.provided.values()))
-
         # It can, if all the options/parameters are specified or have defaults
         error_reason = self._get_invoking_pars()[0]
-        return (required or something_provided()) and error_reason
+        # if not required, only if the user provided any value
+        return (required or self.provided_mask or self.provided_pars) and \
+            error_reason
 
     def _get_invoking_pars(self):
         # Returns the parameters required to invoke the underlying function.
         # It returns a tuple (problem, *args, **kwargs)
         args, parameters = [], self.provided_pars[:]
+        # prefixes are always available, even if no value was provided
+        provided = self.provided_mask | self.prefixes_mask
         # we only check the indexes 1...last_arg, so the orphan flags are not
         # checked here (they are not used to invoke the method)
         for i in range(1, self.last_arg):
-            try:
+            if provided & (1 << i):
                 value = self.provided[i]  # read first the provided value
-            except KeyError:
+            else:
                 # otherwise, the current index could refer to a parameter,
                 # which are stored separately
                 if i in self.pars and parameters:
@@ -735,16 +1506,76 @@ class OptMatcherHandler(OptMatcherInfo):
             args.append(value)
         # if the function defined a *arg parameter, it can handle the
         # remaining provided parameters (if not, we would had already an error)
+        if self.vararg_convert:
+            parameters = self._convert_vararg(parameters)
         args.extend(parameters)
         # It must be still checked the orphan flags' variables
         # These are not passed to the method, but must have been provided to
         # consider that the method can be invoked
-        for c in range(self.orphan_flags, 0):
-            if c not in self.provided:
-                return 'Missing required ' + self.get_index_name(c), None, None
+        if self.orphans_mask & ~provided:
+            for c in range(self.orphan_flags, 0):
+                if not provided & (1 << c % self.slots):
+                    return ('Missing required ' + self.get_index_name(c),
+                            None, None)
 
         return None, args, self.kwargs or {}
 
+    def get_completions(self, values=True):
+        """Returns the flags/options/prefixes that could follow, in
+        the current status, as they would be written on the command line
+        If values is True, it includes as well the options with their
+        known values
+        """
+        ret, mode = [], self.mode
+        for group, suffix in ((self.flags, ''), (self.options, None),
+                              (self.prefixes, '')):
+            for name, index in group.items():
+                if (self.is_provided(index) and group is not self.prefixes
+                        and index not in self.counters
+                        and index not in self.multiples):
+                    continue  # already given, cannot be provided again
+                prefix = mode.get_option_prefix(name)
+                if suffix is None:
+                    if len(prefix) < len(mode.option):
+                        ret.append(prefix + name)  # short option, getopt
+                    else:
+                        ret.append(prefix + name + mode.assigner)
+                        if values:
+                            ret.extend(self._get_values_completions(
+                                prefix + name + mode.assigner, index))
+                else:
+                    ret.append(prefix + name)
+        return ret
+
+    def get_option_values(self, name):
+        """Returns the known values for the given option, if defined"""
+        try:
+            return self._get_values_completions('', self.options[name])
+        except KeyError:
+            return []
+
+    def _get_values_completions(self, prefix, index):
+        # The only known value for an option is its default, if any
+        default = self.defaults.get(index)
+        if isinstance(default, str) and default:
+            return [prefix + default]
+        return []
+
+    def _convert_vararg(self, parameters):
+        # Converts in bulk the parameters to pass as *args. The result is
+        #  memoized, as the handler is first checked, then invoked
+        converted = self.converted_vararg
+        if converted is None or converted[0] != len(self.provided_pars):
+            try:
+                values = self.vararg_convert.convert_values(parameters)
+            except ValueError as ex:
+                # the exception's argument is the culprit
+                raise UsageException('Incorrect value for argument ' +
+                                     str(ex.args[0]))
+            converted = self.converted_vararg = (len(self.provided_pars),
+                                                 values)
+        return converted[1]
+
     def handle_arg(self, command_line):
         """Handles one argument in the command line"""
         # Returns None if ok, otherwise the reason why it cannot consume the
@@ -768,6 +1599,18 @@ class OptMatcherHandler(OptMatcherInfo):
         command_line.set_arg_handled()
         return None
 
+    def accepts_long_option(self, name):
+        """Returns whether the given long option would be handled"""
+        if name in self.defs and (name in self.options or
+                                  name in self.flags):
+            return True
+        return (self.supports_k_w_args() or
+                self._split_prefix(name)[0] is not None)
+
+    def accepts_parameter(self):
+        """Returns whether one more parameter would be handled"""
+        return self.vararg or len(self.provided_pars) < len(self.pars)
+
     def _handle_long_arg(self, cmd):
         """Handles one long argument in the command line."""
         name = cmd.name
@@ -780,7 +1623,7 @@ class OptMatcherHandler(OptMatcherInfo):
         if flag:
             if cmd.split:  # flag, but user specified a value
                 raise UsageException('Incorrect flag ' + name)
-            self.provided[flag] = True
+            self._set_flag(flag)
         else:
             prefix, name = self._split_prefix(name)
             if prefix:
@@ -792,7 +1635,7 @@ class OptMatcherHandler(OptMatcherInfo):
                             'Incorrect prefix usage on argument ' + cmd.arg)
                     # note that cmd.value is the value of next argument now
                     name = cmd.name
-                self.provided[prefix].append((name, cmd.value))
+                self._add_prefix(prefix, name, cmd.value)
             else:  # try now the self.kwargs, if possible
                 try:
                     self.kwargs[cmd.name] = cmd.value
@@ -811,7 +1654,7 @@ class OptMatcherHandler(OptMatcherInfo):
             return 'Unexpected flag ' + name + ' in argument ' + cmd.arg
         flag = self.flags.get(name, None)
         if flag:
-            self.provided[flag] = True
+            self._set_flag(flag)
             cmd.set_short_arg_handled()
         elif not self._handle_option(cmd):
             prefix = self.prefixes.get(name, None)
@@ -821,7 +1664,7 @@ class OptMatcherHandler(OptMatcherInfo):
                 if cmd.set_arg_handled():
                     raise UsageException('Incorrect prefix ' + name)
                 cmd.value = cmd.arg
-            self.provided[prefix].append(cmd.separate(cmd.value)[1:])
+            self._add_prefix(prefix, *cmd.separate(cmd.value)[1:])
             cmd.set_arg_handled()
         return None
 
@@ -846,13 +1689,65 @@ class OptMatcherHandler(OptMatcherInfo):
                 value = self.converts[option](value)
             except KeyError:
                 # no conversion required, we treat it always as file
-                value = os.path.expanduser(os.path.expandvars(value))
+                value = cmd.expand(value)
             except ValueError:
                 raise UsageException('Incorrect value for ' + name)
-            self.provided[option] = value
+            if option in self.multiples:
+                self._add_multiple(option, value)
+            else:
+                self.provided[option] = value
+                self.provided_mask |= 1 << option
             cmd.set_arg_handled()
         return option
 
+    def is_provided(self, index):
+        """Returns whether the parameter with the given index was provided"""
+        return bool(self.provided_mask & (1 << index % self.slots))
+
+    def _set_flag(self, flag):
+        # Sets the given flag as provided, or counts it, for count_flags
+        bit = 1 << flag % self.slots
+        if flag not in self.counters:
+            self.provided[flag] = True
+        elif self.provided_mask & bit:
+            self.provided[flag] += 1
+        else:
+            self.provided[flag] = 1
+        self.provided_mask |= bit
+
+    def _add_prefix(self, prefix, name, value):
+        # Adds a new definition to the given prefix. Prefixes are stored as
+        #  lists of (name, value) tuples, unless defined as dict_prefixes
+        values = self.provided[prefix]
+        self.provided_mask |= 1 << prefix
+        if prefix not in self.dict_prefixes:
+            values.append((name, value))
+            return
+        policy = self.duplicates[prefix]
+        if policy == 'collect':
+            values.setdefault(name, []).append(value)
+        elif name not in values or policy == 'last':
+            values[name] = value
+        elif policy == 'error':
+            raise UsageException('Duplicated prefix definition ' + name)
+
+    def _add_multiple(self, option, value):
+        # Adds a new value to an option that can be provided multiple times
+        if self.provided_mask & (1 << option):
+            self.provided[option].append(value)
+        elif self.pooled and self.provided[option] is not None:
+            # reuse the container of a previous call
+            del self.provided[option][:]
+            self.provided[option].append(value)
+            self.provided_mask |= 1 << option
+        else:
+            typecode = self.multiples[option]
+            if typecode:
+                self.provided[option] = array.array(typecode, [value])
+            else:
+                self.provided[option] = [value]
+            self.provided_mask |= 1 << option
+
     def _split_prefix(self, name):
         # Splits an existing prefix from the given name.
         #   It does not apply to short prefixes (getopt mode)
@@ -862,6 +1757,190 @@ class OptMatcherHandler(OptMatcherInfo):
                 return self.prefixes[each], name[len(each):]
         return None, None
 
+    def specialize(self):
+        """Replaces handle_arg with a function generated for this handler,
+        with all its definitions inlined as constants. The compiled code
+        is cached, and shared by handlers with the same definitions
+        """
+        source, namespace = self.get_parser_source()
+        try:
+            code = _GENERATED_PARSERS[source]
+        except KeyError:
+            code = compile(source, '<optmatch: %s>' % self.describe(), 'exec')
+            _GENERATED_PARSERS[source] = code
+        exec(code, namespace)
+        self.handle_arg = types.MethodType(namespace['handle_arg'], self)
+
+    def get_parser_source(self):
+        """Returns the source of the handle_arg function specialized for
+        this handler, and the namespace required to execute it.
+        The generated function must behave exactly as handle_arg
+        """
+        namespace = {'UsageException': UsageException}
+        long_cases = []
+        for name in sorted(self.defs):
+            index = self.options.get(name)
+            if index:
+                long_cases.append((name, self._get_option_source(
+                    name, index, namespace)))
+            elif name in self.flags:
+                long_cases.append((name, [
+                    'if cmd.split:',
+                    '    raise UsageException(%r)' %
+                    ('Incorrect flag ' + name)] +
+                    self._get_flag_source(self.flags[name]) +
+                    ['cmd.set_arg_handled()',
+                     'return None']))
+        long_code = self._get_chain_source(long_cases)
+        for name, index in self.prefixes.items():
+            if name in self.defs:
+                long_code.extend(self._get_long_prefix_source(name, index))
+        if self.supports_k_w_args():
+            long_code.extend(['self.kwargs[cmd.name] = cmd.value',
+                              'cmd.set_arg_handled()',
+                              'return None'])
+        else:
+            long_code.append("return 'Unexpected argument: ' + cmd.arg")
+
+        code = ['if cmd.option:', '    name = cmd.name']
+        if self.mode.getopt:
+            short_cases = []
+            for name in sorted(self.short_defs):
+                if self.flags.get(name):
+                    short_cases.append((name,
+                                        self._get_flag_source(
+                                            self.flags[name]) +
+                                        ['cmd.set_short_arg_handled()',
+                                         'return None']))
+                elif self.options.get(name):
+                    short_cases.append((name, self._get_option_source(
+                        name, self.options[name], namespace)))
+                else:
+                    short_cases.append((name, [
+                        'if not cmd.value:',
+                        '    if cmd.set_arg_handled():',
+                        '        raise UsageException(%r)' %
+                        ('Incorrect prefix ' + name),
+                        '    cmd.value = cmd.arg',
+                        'self._add_prefix(%d, *cmd.separate(cmd.value)[1:])'
+                        % self.prefixes[name],
+                        'cmd.set_arg_handled()',
+                        'return None']))
+            code.append('    if cmd.is_short:')
+            code.extend(self._indent(self._get_chain_source(short_cases), 8))
+            code.append("        return ('Unexpected flag ' + name + "
+                        "' in argument ' + cmd.arg)")
+        code.extend(self._indent(long_code, 4))
+        if not self.vararg:
+            code.extend(['if len(self.provided_pars) >= %d:' % len(self.pars),
+                         "    return 'Unexpected argument: ' + cmd.arg"])
+        code.extend(['self.provided_pars.append(cmd.arg)',
+                     'cmd.set_arg_handled()',
+                     'return None'])
+        source = 'def handle_arg(self, cmd):\n%s\n' % \
+            '\n'.join(self._indent(code, 4))
+        return source, namespace
+
+    def _get_option_source(self, name, index, namespace):
+        # Returns the source handling the given option, see _handle_option
+        ret = ['if cmd.value:', '    value = cmd.value', 'else:']
+        error = '    raise UsageException(%r)' % ('Incorrect option ' + name)
+        if self.mode.getopt:
+            ret.extend(['    if cmd.set_arg_handled() or cmd.split:',
+                        '    ' + error,
+                        '    value = cmd.arg'])
+        else:
+            ret.append(error)
+        if index in self.converts:
+            namespace['convert%d' % index] = self.converts[index]
+            ret.extend(['try:',
+                        '    value = convert%d(value)' % index,
+                        'except ValueError:',
+                        '    raise UsageException(%r)' %
+                        ('Incorrect value for ' + name)])
+        else:
+            ret.append('value = cmd.expand(value)')
+        if index in self.multiples:
+            ret.append('self._add_multiple(%d, value)' % index)
+        else:
+            ret.extend(['self.provided[%d] = value' % index,
+                        'self.provided_mask |= %d' % (1 << index)])
+        ret.extend(['cmd.set_arg_handled()', 'return None'])
+        return ret
+
+    def _get_flag_source(self, index):
+        # Returns the source setting the given flag, see _set_flag
+        if index in self.counters:
+            return ['self._set_flag(%d)' % index]
+        return ['self.provided[%d] = True' % index,
+                'self.provided_mask |= %d' % (1 << index % self.slots)]
+
+    def _get_long_prefix_source(self, name, index):
+        # Returns the source handling the given long prefix, if matched
+        if self.mode.getopt:
+            check = 'cmd.split or cmd.set_arg_handled()'
+        else:
+            check = 'True'
+        return ['if name.startswith(%r):' % name,
+                '    rest = name[%d:]' % len(name),
+                '    if not rest:',
+                '        if %s:' % check,
+                '            raise UsageException(',
+                "                'Incorrect prefix usage on argument ' + "
+                "cmd.arg)",
+                '        rest = cmd.name',
+                '    self._add_prefix(%d, rest, cmd.value)' % index,
+                '    cmd.set_arg_handled()',
+                '    return None']
+
+    @staticmethod
+    def _get_chain_source(cases):
+        # Returns the source comparing the variable name with each case's
+        # name, running the case's code if equal. Cases are sorted by name,
+        # and compared as a binary search tree, ending on if/elif chains.
+        # The code of each case must return or raise
+        indent = OptMatcherHandler._indent
+        if len(cases) > 3:
+            middle = len(cases) // 2
+            return (['if name < %r:' % cases[middle][0]] +
+                    indent(OptMatcherHandler._get_chain_source(
+                        cases[:middle]), 4) +
+                    ['else:'] +
+                    indent(OptMatcherHandler._get_chain_source(
+                        cases[middle:]), 4))
+        ret = []
+        for i, (name, code) in enumerate(cases):
+            ret.append('%s name == %r:' % ('elif' if i else 'if', name))
+            ret.extend(indent(code, 4))
+        return ret
+
+    @staticmethod
+    def _indent(lines, spaces):
+        return [' ' * spaces + line for line in lines]
+
+
+class AbbreviationIndex(object):
+    """Internal class, resolves the unique prefixes of the long options,
+    flags and prefixes, kept as a sorted list
+    """
+
+    def __init__(self, names, prefixes):
+        self.names = sorted(set(names))
+        self.exact = set(self.names)
+        self.prefixes = tuple(prefixes)
+
+    def resolve(self, name):
+        """Returns the list of names abbreviated by the given one -only
+        the name itself if it is defined, or if it starts with a defined
+        prefix, like -Dname=value-"""
+        if name in self.exact or name.startswith(self.prefixes):
+            return [name]
+        names = self.names
+        start = end = bisect.bisect_left(names, name)
+        while end < len(names) and names[end].startswith(name):
+            end += 1
+        return names[start:end]
+
 
 class UsageAccessor(object):
     """Class to access and to format usage info"""
@@ -936,15 +2015,20 @@ class UsageAccessor(object):
             alternatives = self.get_alternatives()
             alt_options = [self.get_options(a) for a in range(alternatives)]
             alt_params = [self.get_parameters(a) for a in range(alternatives)]
+            alt_commands = [list(self.handlers[a][0].command)
+                            for a in range(alternatives)]
             if include_usage:
                 self.add('Usage:')
                 if alternatives == 1:
                     # if there is one single alternative, it is shown fully
                     # expanded, with options and default values
-                    self.add(alt_options[0] + alt_params[0])
+                    self.add(alt_commands[0] + alt_options[0] +
+                             alt_params[0])
                 else:
                     # Otherwise, get_all_parameters provide the intersection of
                     # names among all alternatives
+                    if any(alt_commands):
+                        self.add('command')
                     if options:
                         self.add('[common options]')
                     self.add(self.get_all_parameters())
@@ -962,7 +2046,7 @@ class UsageAccessor(object):
                 self.add_line()
                 self.add_line('alternatives:')
                 for i in range(alternatives):
-                    content = alt_options[i] + alt_params[i]
+                    content = alt_commands[i] + alt_options[i] + alt_params[i]
                     self.add_line()
                     self.add_line('*')
                     self.add(content, ident)
@@ -1069,11 +2153,297 @@ class UsageAccessor(object):
         return options
 
 
+_COMPLETION_SCRIPTS = {
+    'bash': '''# bash completion for %(prog)s, generated by optmatch
+_optmatch_%(name)s()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    local words=(%(words)s)
+    local commands=(%(commands)s)
+    if [[ "$cur" == -* ]]; then
+        COMPREPLY=($(compgen -W "${words[*]}" -- "$cur"))
+        if [[ ${#COMPREPLY[@]} -eq 1 && "${COMPREPLY[0]}" == *= ]]; then
+            compopt -o nospace 2>/dev/null
+        fi
+    else
+        # the command words following the leading words given
+        local prefix="${COMP_WORDS[*]:1:COMP_CWORD-1}" each next=()
+        [[ -n "$prefix" ]] && prefix+=" "
+        for each in "${commands[@]}"; do
+            if [[ "$each" == "$prefix"* && "${each#"$prefix"}" != *' '* ]]
+            then
+                next+=("${each#"$prefix"}")
+            fi
+        done
+        COMPREPLY=($(compgen -W "${next[*]}" -- "$cur")
+                   $(compgen -f -- "$cur"))
+    fi
+}
+complete -F _optmatch_%(name)s %(prog)s
+''',
+    'zsh': '''# zsh completion for %(prog)s, generated by optmatch
+_optmatch_%(name)s()
+{
+    local -a options commands
+    options=(%(words)s)
+    commands=(%(commands)s)
+    if [[ "$PREFIX" == -* ]]; then
+        compadd -S '' -- ${(M)options:#*=}
+        compadd -- ${options:#*=}
+    else
+        # the command words following the leading words given
+        local prefix="${(j: :)words[2,CURRENT-1]}" each
+        [[ -n "$prefix" ]] && prefix+=" "
+        for each in $commands; do
+            if [[ "$each" == "$prefix"* && "${each#$prefix}" != *' '* ]]
+            then
+                compadd -- "${each#$prefix}"
+            fi
+        done
+        _files
+    fi
+}
+compdef _optmatch_%(name)s %(prog)s
+'''
+}
+
+
+class MatcherPlan(object):
+    """Internal class, holds the handlers built for an OptionMatcher.
+    It is built once, and reused on each processing, resetting the handlers.
+    As the handlers keep the state of the processing, the plan is only
+    used while its lock is acquired -see OptionMatcher._acquire_plan-
+    """
+
+    def __init__(self, matchers, commons, help_handler=None):
+        self.lock = threading.Lock()
+        self.matchers = matchers
+        self.commons = commons
+        self.help_handler = help_handler  # the default help matcher
+        # applicability matrix: for each matcher, the indexes of the
+        #  common handlers that apply to it
+        self.applicable = [[i for i, c in enumerate(commons)
+                            if c.applies_to_matcher(m)] for m in matchers]
+        self._applicable_commons = dict(
+            [(m, [commons[i] for i in indexes])
+             for m, indexes in zip(matchers, self.applicable)])
+        self._routes = {}  # MatcherRoutes, per matcher
+        self._abbreviations = None
+        self.command_line = None  # CommandLine reused, if pooling
+        # subcommands trie: each node maps the next command word to its
+        #  child node, and None to the matchers defined for that command
+        #  (priority sorted). The default help is available on any command
+        self.commands = {None: []}
+        for each in matchers:
+            node = self.commands
+            for word in each.command:
+                node = node.setdefault(word, {None: []})
+            node[None].append(each)
+        if help_handler:
+            self._add_help(self.commands, help_handler)
+
+    def _add_help(self, node, help_handler):
+        for word, child in node.items():
+            if word is not None:
+                if child[None]:
+                    child[None].append(help_handler)
+                self._add_help(child, help_handler)
+
+    def dispatch(self, args):
+        """Resolves the leading command words in the given arguments -the
+        first one is dismissed-, returning a tuple (matchers, depth), with
+        the matchers of the longest command given, and its number of words
+        """
+        node, ret = self.commands, (self.commands[None], 0)
+        for depth in range(1, len(args)):
+            node = node.get(args[depth])
+            if node is None:
+                break
+            if node[None]:
+                ret = node[None], depth
+        return ret
+
+    def get_subcommands(self, args):
+        """Returns the command words that could follow the given arguments
+        -the first one is dismissed-"""
+        node = self.commands
+        for word in args[1:]:
+            node = node.get(word)
+            if node is None:
+                return []
+        return [word for word in node if word is not None]
+
+    def get_command_paths(self):
+        """Returns, sorted, the paths of all the commands on the trie: each
+        one is given as its command words, separated by spaces"""
+        ret, pending = [], [('', self.commands)]
+        while pending:
+            path, node = pending.pop()
+            for word, child in node.items():
+                if word is not None:
+                    ret.append(path + word)
+                    pending.append((path + word + ' ', child))
+        return sorted(ret)
+
+    def reset(self):
+        """Resets the status of all the handlers"""
+        for each in self.matchers:
+            each.reset()
+        for each in self.commons:
+            each.reset()
+
+    def get_applicable_commons(self, matcher):
+        """Returns the common handlers that apply to the given matcher"""
+        return self._applicable_commons[matcher]
+
+    def get_abbreviations(self):
+        """Returns the AbbreviationIndex of all the long names defined"""
+        if not self._abbreviations:
+            names, prefixes = [], []
+            for handler in self.matchers + self.commons:
+                names.extend(handler.defs)
+                prefixes.extend([p for p in handler.prefixes
+                                 if p in handler.defs])
+            self._abbreviations = AbbreviationIndex(names, prefixes)
+        return self._abbreviations
+
+    def get_routes(self, matcher):
+        """Returns the MatcherRoutes for the given matcher and its
+        common handlers. They are built once, on first usage"""
+        try:
+            return self._routes[matcher]
+        except KeyError:
+            ret = MatcherRoutes([matcher] +
+                                self.get_applicable_commons(matcher))
+            self._routes[matcher] = ret
+            return ret
+
+
+class MatcherRoutes(object):
+    """Internal class, routes each argument directly to the handler that
+    would accept it among a matcher and its common handlers, which is the
+    first one defining it, as when the handlers are tried in order
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        # short options table (getopt mode), each short name mapped to its
+        #  handler and flag index, see CommandLine.handle_short_cluster
+        self.short_options = {}
+        # long options table: each name mapped to its handler
+        self.long_options = {}
+        # static requirements to handle a command line: the minimum and
+        #  maximum number of parameters (None if unlimited), and, for each
+        #  option required by the matcher, the set of its names
+        matcher = handlers[0]
+        self.min_parameters = len([i for i in matcher.pars
+                                   if i not in matcher.defaults])
+        self.max_parameters = None
+        if not any([h.vararg for h in handlers]):
+            self.max_parameters = sum([len(h.pars) for h in handlers])
+        required = {}
+        for group in matcher.flags, matcher.options:
+            for name, index in group.items():
+                if index not in matcher.defaults:
+                    required.setdefault(index, set()).add(name)
+        self.required_names = list(required.values())
+        for handler in handlers:
+            if handler.mode.getopt:
+                for name in handler.short_defs:
+                    if name not in self.short_options:
+                        self.short_options[name] = (handler,
+                                                    handler.flags.get(name))
+            for name in handler.defs:
+                if name not in self.long_options:
+                    owner = self._find_long_owner(name)
+                    if owner:
+                        self.long_options[name] = owner
+        # converting the varargs can raise an exception, see can_skip
+        self.converts_varargs = any([h.vararg_convert for h in handlers])
+        # without prefixes or kwargs, only the names on the tables are
+        #  accepted
+        self.open_names = any([h.prefixes or h.supports_k_w_args()
+                               for h in handlers])
+
+    def can_skip(self, summary):
+        """Returns True if the handlers cannot handle a command line with
+        the given summary -see CommandLine.summarize-, and trying them
+        would not raise an UsageException either: they accept none of the
+        options given, so the first option is just rejected, and before
+        it, only non option arguments are handled"""
+        if self.converts_varargs or self.may_accept(summary):
+            return False
+        names = summary[2]
+        if not (names.isdisjoint(self.long_options) and
+                names.isdisjoint(self.short_options)):
+            return False
+        if self.open_names:
+            for name in names:
+                for handler in self.handlers:
+                    if handler.accepts_long_option(name):
+                        return False
+        return True
+
+    def may_accept(self, summary):
+        """Returns False if the handlers cannot handle a command line with
+        the given summary, see CommandLine.summarize"""
+        parameters, options, names = summary
+        if parameters < self.min_parameters:
+            return False
+        if (self.max_parameters is not None and
+                parameters - options > self.max_parameters):
+            return False
+        for each in self.required_names:
+            if each.isdisjoint(names):
+                return False
+        return True
+
+    def feed(self, command_line):
+        """Passes all the arguments in the command line to their handlers.
+        It returns None if all are consumed, or the reason why an argument
+        could not be handled
+        """
+        while not command_line.finished():
+            if command_line.option:
+                if command_line.is_short:
+                    problem = command_line.handle_short_cluster(
+                        self.short_options)
+                    if problem:
+                        return problem
+                    continue
+                name = command_line.name
+                owner = (self.long_options.get(name) or
+                         self._find_long_owner(name))
+            else:
+                for owner in self.handlers:
+                    if owner.accepts_parameter():
+                        break
+                else:
+                    owner = None
+            if not owner:
+                return 'Unexpected argument: ' + command_line.arg
+            problem = owner.handle_arg(command_line)
+            if problem:
+                return problem
+        return None
+
+    def _find_long_owner(self, name):
+        # Returns the first handler accepting the given long name, if any
+        for each in self.handlers:
+            if each.accepts_long_option(name):
+                return each
+        return None
+
+
 class OptionMatcher(object):
     """ Class handling command line arguments by matching method parameters.
     It supports naturally the handling of mutually exclusive options.
     """
 
+    # keys of a spec entry that are not decorator parameters, see add_spec
+    _SPEC_KEYS = ('name', 'parameters', 'defaults', 'vararg', 'kwargs',
+                  'function', 'target', 'doc')
+
     def __init__(self, aliases=None, options_help=None,
                  option_var_names=None, option_prefix='--', assigner='=',
                  default_help=True):
@@ -1110,6 +2480,13 @@ class OptionMatcher(object):
         Param default_help is True to automatically show the usage when the
             user requests the --help option (or -h)
         """
+        self._plan = None
+        self._loaded_plan = None  # see load_plan
+        self._lazy_handlers = []
+        self._spec_handlers = []
+        self._generate_parsers = False
+        self._abbreviations = False
+        self._pooling = False
         self._mode = UsageMode(option_prefix, assigner)
         self.enable_default_help(default_help)
         self.set_aliases(aliases)
@@ -1118,29 +2495,137 @@ class OptionMatcher(object):
     def enable_default_help(self, set=True):
         """Enables the default help, under 'h' or 'help' """
         self._default_help = set
+        self._plan = None
         return self
 
     def set_aliases(self, aliases):
         """Sets the aliases. See __init__"""
+        self._check_not_loaded('set the aliases')
         self._aliases = aliases
+        self._plan = None
         return self
 
     def set_usage_info(self, options_help, option_var_names):
         """Sets the usage information for each option. See __init__"""
         self._mode.set(options_help=options_help, var_names=option_var_names)
+        self._plan = None
         return self
 
     def set_mode(self, option_prefix, assigner):
         """Sets the working mode. See __init__"""
+        self._check_not_loaded('set the mode')
         self._mode.set(option=option_prefix, assigner=assigner)
+        self._plan = None
+        return self
+
+    def enable_code_generation(self, set=True):
+        """Enables generating, for each matcher and optset, a parser
+        specialized on its definitions, instead of using the generic one.
+        Results are the same, but the processing is faster"""
+        self._generate_parsers = set
+        self._plan = None
+        return self
+
+    def enable_pooling(self, set=True):
+        """Enables reusing, on each process call, the state of the previous
+        one -the handlers' containers, and the parsed command line-,
+        instead of allocating it again.
+        The lists and dicts received by the matchers (prefixes, options
+        provided multiple times) are then cleared on the next call, so
+        they must be copied if kept after the matcher returns"""
+        self._pooling = set
+        self._plan = None
+        return self
+
+    def enable_abbreviations(self, set=True):
+        """Enables the usage of unambiguous abbreviations of the long
+        options, flags and prefixes, like --verb for --verbose"""
+        self._abbreviations = set
+        return self
+
+    def add_lazy_matcher(self, target, signature=None, plan_entry=None,
+                         common=False, **decoration):
+        """Adds a matcher whose function, given by its dotted path -like
+        'package.module:function'-, is only imported when it is the
+        selected matcher, or when the help is requested.
+        The matcher is defined without importing the function, either:
+        - by its signature, as a string like 'file, verbose_flag=False',
+          plus the optional decoration parameters (flags, options, etc).
+        - or by a plan entry, as exported by export_plan.
+        If common is True, the function is added as an optset, not as
+        a matcher
+        """
+        self._check_not_loaded('add matchers')
+        stub = None
+        if plan_entry is None:
+            # the signature is defined on a stub function, to be inspected
+            namespace, name = {}, LazyFunction(target).__name__
+            try:
+                exec('def %s(%s): pass' % (name, signature or ''), namespace)
+            except SyntaxError:
+                raise OptionMatcherException('Invalid signature for %s: %s'
+                                             % (target, signature))
+            decorator = optset if common else optmatcher
+            if decoration:
+                stub = decorator(**decoration)(namespace[name])
+            else:
+                stub = decorator(namespace[name])
+        self._lazy_handlers.append((target, stub, plan_entry, common))
+        self._plan = None
+        return self
+
+    def add_spec(self, spec):
+        """Adds the matchers and optsets defined on the given spec, a
+        dictionary with the optional keys:
+        - 'matchers' and 'optsets': lists of dictionaries, each defining
+          a matcher or optset with the keys:
+          - 'name': required, the name of the function.
+          - 'parameters': the list of parameter names, in order.
+          - 'defaults': dictionary of default values, by parameter name.
+          - 'vararg', 'kwargs': True to accept the extra parameters.
+          - 'function' (a callable) or 'target' (a dotted path, imported
+             only when invoked, see add_lazy_matcher). Without them, the
+             matcher can be only used with parse.
+          - 'doc': the documentation, if not taken from the function.
+          - any parameter of the optmatcher or optset decorators, like
+            'flags', 'options' or 'priority'. The definitions can be
+            given as well as lists of names.
+        - 'aliases': added to the aliases, see __init__.
+        No function is inspected: the handlers are built from the spec
+        """
+        self._check_not_loaded('add matchers')
+        try:
+            for entries, common in ((spec.get('matchers'), False),
+                                    (spec.get('optsets'), True)):
+                for entry in entries or []:
+                    self._spec_handlers.append(
+                        (self._create_spec_function(entry, common), entry))
+            aliases = spec.get('aliases')
+        except (AttributeError, KeyError, TypeError):
+            raise OptionMatcherException('Invalid spec')
+        if aliases:
+            self.set_aliases(dict(self._aliases or {}, **aliases))
+        self._plan = None
         return self
 
+    def _create_spec_function(self, entry, common):
+        # Returns the _SpecFunction for a spec entry, decorated as given
+        decoration = dict([(k, v) for k, v in entry.items()
+                           if k not in self._SPEC_KEYS])
+        function = entry.get('function')
+        if 'target' in entry:
+            function = LazyFunction(entry['target'])
+        ret = _SpecFunction(entry['name'], function, entry.get('doc'))
+        try:
+            return (optset if common else optmatcher)(**decoration)(ret)
+        except TypeError:
+            raise OptionMatcherException('Invalid spec for ' + ret.__name__)
+
     def get_usage(self):
         """Returns an Usage object to handle the usage info"""
-        matcher_handlers, common_handlers = self._create_handlers()
-        handlers = [[m] + list(filter(lambda x: x.applies_to_matcher(m),
-                                      common_handlers))
-                    for m in matcher_handlers]
+        plan = self._get_plan()
+        handlers = [[m] + plan.get_applicable_commons(m)
+                    for m in plan.matchers]
         return UsageAccessor(handlers, self._mode)
 
     def print_help(self):
@@ -1154,35 +2639,59 @@ class OptionMatcher(object):
         Param handle_usage_problems. If not False, it automatically catches
             UsageExceptions, returning the value handle_usage_problems
         """
-        matchers, commons = self._create_handlers()
-        command_line = CommandLine(args, self._mode, gnu)
-        highest_problem = (-1, 0), 'Invalid command line input'
+        return self._run(args, gnu, handle_usage_problems,
+                         lambda plan, handler: handler.invoke())
+
+    def parse(self, args, gnu=False, handle_usage_problems=True):
+        """Processes the given command line arguments as process does, but
+        instead of invoking the selected matcher, it returns its values
+        as an instance of a ParsedArguments subclass, specific to the
+        matcher, with an attribute for each parameter of its function.
+        The common handlers are still invoked, as is the default help
+        """
+        def get_result(plan, handler):
+            if handler is plan.help_handler:
+                return handler.invoke()
+            return handler.get_result()
+        return self._run(args, gnu, handle_usage_problems, get_result)
+
+    def _run(self, args, gnu, handle_usage_problems, complete):
+        # Finds the matcher for the given arguments, invoking the common
+        # handlers, and returns the result of complete(plan, matcher)
+        plan = self._acquire_plan()
+        try:
+            return self._run_plan(plan, args, gnu, handle_usage_problems,
+                                  complete)
+        finally:
+            plan.lock.release()
+
+    def _run_plan(self, plan, args, gnu, handle_usage_problems, complete):
+        # Implements _run, on the given plan, already acquired
+        plan.reset()
+        # only the matchers for the given subcommand are tried, if any
+        matchers, depth = plan.dispatch(args)
+        if depth:
+            args = args[:1] + args[depth + 1:]
+        abbreviations = self._abbreviations and plan.get_abbreviations()
+        command_line = plan.command_line
+        if command_line:
+            command_line.restart(args, gnu, abbreviations)
+        else:
+            command_line = CommandLine(args, self._mode, gnu, abbreviations)
+            if self._pooling:
+                plan.command_line = command_line
 
-        # the method is simple: for each matcher, we verify if the arguments
-        # suit it, taking in consideration the common handler, if given.
-        # As soon as a matcher can handle the arguments, we invoke it, as well
-        # as the common handler, if given.
         try:
-            for handler in matchers:
-                # only use the common handlers that apply to the matcher
-                assoc_commons = list(filter(lambda x:
-                                            x.applies_to_matcher(handler),
-                                            commons))
-                problem = self._try_handlers(assoc_commons,
-                                             handler, command_line)
-                if not problem:
-                    # ok: invoke common handler, then matcher's handler
-                    for each in assoc_commons:
-                        each.invoke()
-                    return handler.invoke()
-                position = command_line.get_position()
-                if position > highest_problem[0]:
-                    highest_problem = position, problem
-                    # prepare command line, common handlers for next loop
-                command_line.reset()
-                for each in commons:
-                    each.reset()
-            raise UsageException(highest_problem[1])
+            # the matchers that cannot handle the arguments -given the
+            # number of parameters, and the required options- are tried
+            # last, unless they could raise an exception, as the result must
+            # be the same
+            handler = self._find_matcher(plan, matchers, command_line,
+                                         command_line.summarize())
+            # ok: invoke common handlers, then complete with the matcher
+            for each in plan.get_applicable_commons(handler):
+                each.invoke()
+            return complete(plan, handler)
         except UsageException as ex:
             if handle_usage_problems is not False:
                 import sys
@@ -1191,18 +2700,485 @@ class OptionMatcher(object):
             else:
                 raise
 
-    def _create_handlers(self):
+    def process_captured(self, args, env=None, cwd=None, gnu=False):
+        """Processes the given command line arguments, capturing the
+        output. It returns a tuple (status, stdout, stderr), where the
+        status is 2 for usage problems, the value returned by the handler
+        if it is an integer, 1 if it returns False, and 0 otherwise
+        Param env, if given, is the environment to use during processing
+        Param cwd, if given, is the working directory during processing
+        """
+        import traceback
+        try:
+            from StringIO import StringIO  # python 2
+        except ImportError:
+            from io import StringIO
+        out, err, previous = StringIO(), StringIO(), (sys.stdout, sys.stderr)
+        previous_env, previous_cwd = None, None
+        try:
+            if env is not None:
+                previous_env = dict(os.environ)
+                os.environ.clear()
+                os.environ.update(env)
+            if cwd is not None:
+                previous_cwd = os.getcwd()
+                os.chdir(cwd)
+            sys.stdout, sys.stderr = out, err
+            try:
+                result = self.process(args, gnu, handle_usage_problems=False)
+                if result is False:
+                    status = 1
+                elif isinstance(result, int) and result is not True:
+                    status = result
+                else:
+                    status = 0
+            except UsageException as ex:
+                err.write(str(ex) + '\n')
+                status = 2
+            except SystemExit as ex:
+                status = ex.code if isinstance(ex.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        finally:
+            sys.stdout, sys.stderr = previous
+            if previous_cwd is not None:
+                os.chdir(previous_cwd)
+            if previous_env is not None:
+                os.environ.clear()
+                os.environ.update(previous_env)
+        return status, out.getvalue(), err.getvalue()
+
+    def create_server(self, path, gnu=False, fork=False):
+        """Creates a server on the given unix socket path, processing
+        the command lines sent by clients -see run_client-. As the plan is
+        built only once, each request avoids the python startup and
+        the inspection of the decorated methods.
+        Requests are handled one at a time, unless fork is True: in this
+        case, each request is handled on a new forked process, which
+        is useful for handlers that are not safe to be run repeatedly on
+        the same process. The built plan is then frozen -on python 3.7+-
+        to keep its memory shared among the forked processes.
+        The returned server must be run with serve_forever, and stopped
+        with shutdown and server_close
+        """
+        try:
+            import socketserver
+        except ImportError:  # python 2
+            import SocketServer as socketserver
+        import gc
+        import stat
+        matcher = self
+
+        class RequestHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                request = _receive_message(self.request)
+                status, out, err = matcher.process_captured(
+                    request['args'], request.get('env'), request.get('cwd'),
+                    gnu)
+                _send_message(self.request, {'status': status,
+                                             'stdout': out, 'stderr': err})
+
+        class Server(socketserver.UnixStreamServer):
+            def server_close(self):
+                socketserver.UnixStreamServer.server_close(self)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+        if fork:
+            class Server(socketserver.ForkingMixIn, Server):
+                pass
+
+        # a stale socket (not any other file) is removed
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+        self._get_plan()
+        if fork and hasattr(gc, 'freeze'):
+            # objects created so far are moved to a permanent generation,
+            # so the garbage collector does not touch (copy) their pages
+            gc.collect()
+            gc.freeze()
+        return Server(path, RequestHandler)
+
+    def serve(self, path, gnu=False, fork=False):
+        """Serves requests on the given unix socket path, forever.
+        See create_server
+        """
+        server = self.create_server(path, gnu, fork)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def repl(self, prompt='> ', prog=None, stream=None, gnu=False):
+        """Runs an interactive loop, reading command lines and processing
+        each one, until the end of the input. Usage problems are reported
+        on the standard error, without ending the loop.
+        Lines are split following the shell syntax, and the program
+        name -prog, by default sys.argv[0]- is prepended to each command.
+        If a stream is given, the lines are read from it; otherwise, they
+        are read from the standard input, with readline completion
+        """
+        import shlex
+        prog = sys.argv[0] if prog is None else prog
+        readline, previous = None, None
+        if stream is None:
+            try:
+                import readline
+            except ImportError:
+                pass
+            else:
+                previous = readline.get_completer()
+                previous_delims = readline.get_completer_delims()
+                readline.set_completer(self._get_completer(prog, readline,
+                                                           gnu))
+                readline.set_completer_delims(' \t\n')
+                readline.parse_and_bind('tab: complete')
+        try:
+            while True:
+                if stream is None:
+                    try:
+                        line = read_input(prompt)
+                    except EOFError:
+                        sys.stdout.write('\n')
+                        break
+                    except KeyboardInterrupt:
+                        sys.stdout.write('\n')
+                        continue
+                else:
+                    line = stream.readline()
+                    if not line:
+                        break
+                try:
+                    args = shlex.split(line)
+                    if args:
+                        self.process([prog] + args, gnu,
+                                     handle_usage_problems=False)
+                except (UsageException, ValueError) as ex:
+                    sys.stderr.write(str(ex) + '\n')
+        finally:
+            if readline:
+                readline.set_completer(previous)
+                readline.set_completer_delims(previous_delims)
+
+    def run_script(self, stream, prog=None, keep_going=False,
+                   json_output=None, workers=1, gnu=False):
+        """Processes each line in the given stream as a command line,
+        split following the shell syntax -empty lines and comments are
+        dismissed-. The stream is read progressively, and the output of
+        each line is written in order, on the standard output and error,
+        or, if json_output is given, on that stream, as a JSON object per
+        line, with the line number, arguments, status and output.
+        It returns the first non zero status -see process_captured-
+        Param prog is the program name prepended to each command line, by
+            default, sys.argv[0]
+        Param keep_going, if False, stops on the first usage problem
+        Param workers defines the number of processes to use. If greater
+            than 1, the lines are processed on forked processes, each with
+            its own copy of this matcher. Output order is preserved, but
+            when stopping on usage problems, some subsequent lines could
+            have been already processed
+        """
+        import itertools
+        import json
+        prog = sys.argv[0] if prog is None else prog
+        lines = ((number, line, prog, gnu)
+                 for number, line in enumerate(stream, 1))
+        pool = None
+        if workers > 1:
+            import multiprocessing
+            try:
+                context = multiprocessing.get_context('fork')
+            except AttributeError:  # python 2
+                context = multiprocessing
+            except ValueError:
+                raise OptionMatcherException('Workers require fork support')
+            pool = context.Pool(workers, _init_script_worker, (self,))
+
+            def process_batches():
+                batch_size = workers * 256
+                while True:
+                    batch = list(itertools.islice(lines, batch_size))
+                    if not batch:
+                        break
+                    for each in pool.imap(_process_script_worker, batch, 16):
+                        yield each
+
+            results = process_batches()
+        else:
+            results = (self._process_script_line(*each) for each in lines)
+        ret = 0
+        try:
+            for number, args, status, out, err in results:
+                if status is None:
+                    continue  # no command on this line
+                if json_output:
+                    json_output.write(json.dumps(
+                        {'line': number, 'args': args, 'status': status,
+                         'stdout': out, 'stderr': err}) + '\n')
+                else:
+                    sys.stdout.write(out)
+                    sys.stderr.write(err)
+                ret = ret or status
+                if status == 2 and not keep_going:
+                    break
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        return ret
+
+    def _process_script_line(self, number, line, prog, gnu):
+        # Processes one line in a script, returning a tuple (number, args,
+        # status, stdout, stderr). The status is None for empty lines
+        import shlex
+        try:
+            args = shlex.split(line, comments=True)
+        except ValueError as ex:
+            return number, None, 2, '', str(ex) + '\n'
+        if not args:
+            return number, args, None, '', ''
+        return (number, args) + self.process_captured([prog] + args, gnu=gnu)
+
+    def _get_completer(self, prog, readline, gnu):
+        # Returns a readline completer function, using the complete method
+        import shlex
+
+        def completer(text, state):
+            if state == 0:
+                start = readline.get_line_buffer()[:readline.get_begidx()]
+                try:
+                    args = [prog] + shlex.split(start) + [text]
+                    completer.candidates = self.complete(args, gnu=gnu)
+                except (ValueError, OptionMatcherException):
+                    completer.candidates = []
+            try:
+                return completer.candidates[state]
+            except IndexError:
+                return None
+
+        return completer
+
+    def complete(self, args, index=None, gnu=False):
+        """Returns the candidates to complete the argument at the given
+        index (by default, the last one) in the given command line
+        Only the matchers compatible with the previous arguments are
+        considered, and no handler is invoked
+        Param args is the command line, whose first element is dismissed
+        Param gnu determines gnu behaviour, see process
+        """
+        if index is None:
+            index = len(args) - 1
+        plan = self._acquire_plan()
+        try:
+            return self._complete(plan, args, index, gnu)
+        finally:
+            plan.lock.release()
+
+    def _complete(self, plan, args, index, gnu):
+        # Implements complete, on the given plan, already acquired
+        word = args[index]
+        # if the previous argument is an option expecting its value, that
+        #  argument is not considered to verify the compatible matchers
+        option = (index > 1 and
+                  self._get_option_expecting_value(args[index - 1]))
+        if option:
+            args = args[:index - 1]
+        else:
+            args = args[:index]
+        ret = set(plan.get_subcommands(args))
+        matchers, depth = plan.dispatch(args)
+        if depth:
+            args = args[:1] + args[depth + 1:]
+        try:
+            command_line = CommandLine(args, self._mode, gnu,
+                                       self._abbreviations and
+                                       plan.get_abbreviations())
+            for handler in matchers:
+                routes = plan.get_routes(handler)
+                plan.reset()
+                command_line.reset()
+                try:
+                    if routes.feed(command_line):
+                        continue
+                except UsageException:
+                    continue
+                for each in routes.handlers:
+                    if option:
+                        ret.update(each.get_option_values(option))
+                    else:
+                        ret.update(each.get_completions())
+        except UsageException:
+            pass
+        finally:
+            plan.reset()
+        return sorted([c for c in ret if c.startswith(word)])
+
+    def get_applicable_optsets(self):
+        """Returns, for each matcher -by its name-, the names of the optsets
+        that apply to it, in the order they are tried"""
+        plan = self._get_plan()
+        return dict([(m.func.__name__, [plan.commons[i].func.__name__
+                                        for i in indexes])
+                     for m, indexes in zip(plan.matchers, plan.applicable)
+                     if m is not plan.help_handler])
+
+    def export_plan(self):
+        """Returns the plan -all the matchers and optsets, with their
+        flags, options, prefixes, aliases, converters and defaults- as a
+        JSON serializable dictionary. See load_plan
+        """
+        plan = self._get_plan()
+
+        def export(handler):
+            ret = handler.export()
+            # on load, the functions are found by name, or by target
+            if isinstance(handler.func, _SpecFunction) and 'target' not in ret:
+                raise OptionMatcherException(
+                    '%s: Cannot export a spec matcher without target' %
+                    handler.describe())
+            return ret
+
+        return {'format': 'optmatch-plan', 'version': 1,
+                'mode': {'option': self._mode.option,
+                         'assigner': self._mode.assigner},
+                'matchers': [export(m) for m in plan.matchers
+                             if m is not plan.help_handler],
+                'optsets': [export(c) for c in plan.commons]}
+
+    def load_plan(self, plan):
+        """Sets the plan, as returned by export_plan, binding each matcher
+        and optset to the method with the same name. The decorated methods
+        are not inspected at all.
+        The plan defines then the matchers, aliases and mode: they cannot
+        be changed afterwards
+        """
+        if plan.get('format') != 'optmatch-plan' or plan.get('version') != 1:
+            raise OptionMatcherException('Invalid plan')
+        plan = as_native_strings(plan)
+        self._mode.set(**plan['mode'])
+        self._plan = MatcherPlan(*self._create_handlers(plan))
+        self._loaded_plan = plan
+        return self
+
+    def _check_not_loaded(self, change):
+        # Raises an exception if a plan was loaded, see load_plan
+        if self._loaded_plan is not None:
+            raise OptionMatcherException('Cannot %s after load_plan' % change)
+
+    def get_completion_script(self, prog, shell='bash'):
+        """Returns a bash or zsh script to complete the flags/options/
+        prefixes and subcommands of the given program, without requiring
+        python at all
+        The script can be sourced on the shell's initialization files
+        """
+        try:
+            template = _COMPLETION_SCRIPTS[shell]
+        except KeyError:
+            raise OptionMatcherException('Unsupported shell: ' + shell)
+
+        def quote(words):
+            return ' '.join(["'%s'" % w.replace("'", "'\\''")
+                             for w in words])
+
+        commands = self._get_plan().get_command_paths()
+        return template % {'prog': prog,
+                           'words': quote(self.get_completion_words()),
+                           'commands': quote(commands),
+                           'name': re.sub('[^a-zA-Z0-9_]', '_', prog)}
+
+    def get_completion_words(self):
+        """Returns the sorted list of all the flags/options/prefixes
+        defined on any matcher or optset, as used on completion scripts
+        """
+        plan, ret = self._acquire_plan(), set()
+        try:
+            plan.reset()
+            for each in plan.matchers + plan.commons:
+                ret.update(each.get_completions(False))
+        finally:
+            plan.lock.release()
+        return sorted(ret)
+
+    def _get_option_expecting_value(self, arg):
+        # Returns the name of the option that expects its value as next
+        #  argument, or None, if the given argument is not such option
+        if not self._mode.getopt or not arg.startswith('-'):
+            return None
+        plan, options = self._get_plan(), set()
+        for each in plan.matchers + plan.commons:
+            options.update(each.options)
+        if arg.startswith('--'):
+            name = arg[2:]
+            return name if name in options else None
+        for i, name in enumerate(arg[1:]):
+            if name in options:
+                # the remaining characters would be the option's value
+                return name if i == len(arg) - 2 else None
+        return None
+
+    def _get_plan(self):
+        # Returns the plan (the handlers), creating it if needed
+        if not self._plan:
+            self._plan = self._build_plan()
+        return self._plan
+
+    def _build_plan(self):
+        # Returns a new plan, with new handlers -from the loaded plan, if any
+        return MatcherPlan(*self._create_handlers(self._loaded_plan))
+
+    def _acquire_plan(self):
+        # Returns the plan with its lock acquired, to use its handlers.
+        # If it is already in use -a re-entrant call, like process invoked
+        # from an optset, or a call on another thread-, a new plan is
+        # returned instead, not cached, so the handlers are not shared
+        plan = self._get_plan()
+        if not plan.lock.acquire(False):
+            plan = self._build_plan()
+            plan.lock.acquire()
+        return plan
+
+    def _create_handlers(self, plan=None):
         # Returns all the required handlers, as a tuple
-        # the first element is the list of matchers, and the second, the
-        # common matcher
-        def create_handle(function):
+        # the first element is the list of matchers, the second, the
+        # common matchers, and the last one, the default help matcher
+        # If a plan (see export_plan) is given, it is used to create the
+        # handlers, instead of inspecting the decorated methods
+        def create_handle(function, plan_entry=None, spec=None):
             if not function:
                 return None
-            ret = OptMatcherHandler(function, self._mode)
-            if self._aliases:
+            ret = OptMatcherHandler(function, self._mode, plan_entry, spec)
+            # aliases are already included on the plan entries
+            if self._aliases and not plan_entry:
                 ret.set_aliases(self._aliases)
             return ret
 
+        def create_from_plan(entry):
+            if 'target' in entry:
+                function = LazyFunction(entry['target'])
+                if function.__name__ != entry['name']:  # defined on a spec
+                    function = _SpecFunction(entry['name'], function)
+                return create_handle(function, entry)
+            try:
+                function = getattr(self, entry['name'])
+            except AttributeError:
+                raise OptionMatcherException('Unknown method in plan: ' +
+                                             entry['name'])
+            return create_handle(function, entry)
+
+        def create_lazy(target, stub, entry):
+            if entry:
+                return create_handle(LazyFunction(target), entry)
+            # the stub is inspected, but the lazy function is invoked
+            ret = create_handle(stub)
+            ret.func = LazyFunction(target)
+            return ret
+
         if self._default_help:
             if self._mode.getopt:
                 self._aliases = self._aliases or {}
@@ -1210,30 +3186,120 @@ class OptionMatcher(object):
             self._mode.options_help = self._mode.options_help or {}
             self._mode.options_help['help'] = 'shows this help message'
 
-        matchers = [create_handle(f)
-                    for f in Decoration.get_decorated_methods(self, False)]
+        if plan is None:
+            matchers = [create_handle(f) for f in
+                        Decoration.get_decorated_methods(self, False)]
+            commons = [create_handle(f) for f in
+                       Decoration.get_decorated_methods(self, True)]
+            if self._lazy_handlers or self._spec_handlers:
+                for target, stub, entry, common in self._lazy_handlers:
+                    handler = create_lazy(target, stub, entry)
+                    (commons if common else matchers).append(handler)
+                for function, entry in self._spec_handlers:
+                    handler = create_handle(function, spec=entry)
+                    (commons if handler.is_optset else matchers).append(
+                        handler)
+                # keep the priority sorting (stable, as python sort is)
+                matchers.sort(key=lambda x: -x.priority)
+                commons.sort(key=lambda x: -x.priority)
+        else:
+            matchers = [create_from_plan(e) for e in plan['matchers']]
+            commons = [create_from_plan(e) for e in plan['optsets']]
 
         if not matchers:
             raise OptionMatcherException("No matchers defined")
 
-        commons = [create_handle(f)
-                   for f in Decoration.get_decorated_methods(self, True)]
-
+        help_handler = None
         if self._default_help:
             # cannot decorate directly print_help, any instance would
             # get the decoration!
             def surrogate(): return self.print_help()
             surrogate.__doc__ = self.print_help.__doc__
-            matchers.append(create_handle(optmatcher(
-                flags='help', exclusive=True)(surrogate)))
+            help_handler = create_handle(optmatcher(
+                flags='help', exclusive=True)(surrogate))
+            matchers.append(help_handler)
+
+        if self._generate_parsers:
+            for each in matchers + commons:
+                each.specialize()
+
+        if self._pooling:
+            for each in matchers + commons:
+                each.pooled = True
+
+        return matchers, commons, help_handler
+
+    def _find_matcher(self, plan, matchers, command_line, summary=None):
+        # Returns the first matcher that can handle the command line, with
+        # its common handlers, ready to be invoked. Otherwise, it raises an
+        # UsageException with the problem found at the highest position
+        # If given, summary is the CommandLine.summarize' result, used to
+        # skip the matchers that cannot handle the command line, and would
+        # not raise an exception; they are only tried if no matcher is
+        # found, to report the same problem as if none had been skipped
+        problems, skipped = {}, []
 
-        return matchers, commons
-
-    def _try_handlers(self, common_handlers, command_handler, command_line):
+        # the method is simple: for each matcher, we verify if the arguments
+        # suit it, taking in consideration the common handler, if given.
+        for index, handler in enumerate(matchers):
+            routes = plan.get_routes(handler)
+            if summary and routes.can_skip(summary):
+                skipped.append((index, handler, routes))
+                continue
+            problem = self._try_matcher(plan, handler, command_line, routes)
+            if not problem:
+                return handler
+            problems[index] = problem
+        for index, handler, routes in skipped:
+            problem = self._try_matcher(plan, handler, command_line, routes)
+            if not problem:
+                return handler
+            problems[index] = problem
+        # on equal positions, the problem of the first matcher is reported
+        highest_problem = (-1, 0), 'Invalid command line input'
+        for index in sorted(problems):
+            if problems[index][0] > highest_problem[0]:
+                highest_problem = problems[index]
+        raise UsageException(highest_problem[1])
+
+    def _try_matcher(self, plan, handler, command_line, routes):
+        # Checks if the matcher can handle the command line, returning None
+        # if so, or the tuple (position, problem) otherwise, resetting then
+        # the command line and the common handlers for the next matcher
+        # Only the common handlers that apply to the matcher are used
+        problem = self._try_handlers(plan.get_applicable_commons(handler),
+                                     handler, command_line, routes)
+        if not problem:
+            return None
+        position = command_line.get_position()
+        command_line.reset()
+        for each in plan.commons:
+            each.reset()
+        return position, problem
+
+    def _try_handlers(self, common_handlers, command_handler, command_line,
+                      routes=None):
         # Checks if the specified handlers can process the command line.
         # If so, it returns None, letting the handlers ready to be invoked
         # Otherwise, it returns the reason why it cannot be handled
-        handlers = [command_handler] + common_handlers
+        # If given, routes is the MatcherRoutes for the handlers
+        if routes:
+            problem = routes.feed(command_line)
+        else:
+            problem = self._feed_handlers([command_handler] + common_handlers,
+                                          command_line)
+        if problem:
+            return problem
+        for each in common_handlers:
+            problem = each.check_invokable(False)
+            if problem:
+                return problem
+        return command_handler.check_invokable(True)
+
+    def _feed_handlers(self, handlers, command_line):
+        # Passes all the arguments in the command line to the handlers, in
+        # order. It returns None if all are consumed, or the reason why an
+        # argument could not be handled. See MatcherRoutes.feed
         while not command_line.finished():
             for each in handlers:
                 problem = each.handle_arg(command_line)
@@ -1242,11 +3308,7 @@ class OptionMatcher(object):
             else:
                 if problem:
                     return problem
-        for each in common_handlers:
-            problem = each.check_invokable(False)
-            if problem:
-                return problem
-        return command_handler.check_invokable(True)
+        return None
 
 
 class OptionMatcherException(Exception):
@@ -1257,8 +3319,83 @@ class UsageException(OptionMatcherException):
     """Exception raised while handling an argument"""
 
 
+def _send_message(sock, message):
+    # Sends a message (a JSON compatible object) over the given socket,
+    #  prefixed by its length
+    import json
+    import struct
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def _receive_message(sock):
+    # Receives a message, as sent by _send_message
+    import json
+    import struct
+
+    def receive(size):
+        ret = b''
+        while len(ret) < size:
+            data = sock.recv(size - len(ret))
+            if not data:
+                raise OptionMatcherException('Connection closed')
+            ret += data
+        return ret
+
+    size = struct.unpack('>I', receive(4))[0]
+    return json.loads(receive(size).decode('utf-8'))
+
+
+_script_worker = None  # the OptionMatcher used on each script worker
+
+
+def _init_script_worker(matcher):
+    # Initializes a process used to run scripts, see run_script
+    global _script_worker
+    _script_worker = matcher
+
+
+def _process_script_worker(line_info):
+    # Processes one line of a script on a worker process
+    return _script_worker._process_script_line(*line_info)
+
+
+def call_server(path, args, env=None, cwd=None):
+    """Sends the command line to the server listening on the given
+    unix socket path -see OptionMatcher.create_server-. It returns a tuple
+    (status, stdout, stderr) with the result of the processing
+    Param env and cwd define the environment and working directory to
+        use on the server while processing this command line
+    """
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        _send_message(sock, {'args': list(args), 'env': env, 'cwd': cwd})
+        response = _receive_message(sock)
+    finally:
+        sock.close()
+    return response['status'], response['stdout'], response['stderr']
+
+
+def run_client(path, args=None):
+    """Thin client: sends the command line (by default, sys.argv), with
+    the current environment and working directory, to the server listening
+    on the given unix socket path, writes its output and returns its
+    status. Usual usage is: sys.exit(run_client(path))
+    """
+    status, out, err = call_server(path, sys.argv if args is None else args,
+                                   dict(os.environ), os.getcwd())
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    return status
+
+
 def optmatcher(flags=None, options=None, int_options=None, float_options=None,
-               prefixes=None, priority=None, exclusive=False):
+               prefixes=None, priority=None, exclusive=False,
+               raw_options=None, converters=None, varargs=None,
+               count_flags=None, multi_options=None, dict_prefixes=None,
+               duplicates=None, command=None):
     """Decorator defining a function / method as optmatcher choice"""
 
     if exclusive not in [True, False]:
@@ -1266,11 +3403,15 @@ def optmatcher(flags=None, options=None, int_options=None, float_options=None,
 
     return Decoration.decorate(False, flags, options, int_options,
                                float_options, prefixes, priority,
-                               exclusive)
+                               exclusive, raw_options, converters, varargs,
+                               count_flags, multi_options, dict_prefixes,
+                               duplicates, command)
 
 
 def optset(flags=None, options=None, int_options=None, float_options=None,
-           prefixes=None, priority=None, applies=None):
+           prefixes=None, priority=None, applies=None, raw_options=None,
+           converters=None, varargs=None, count_flags=None,
+           multi_options=None, dict_prefixes=None, duplicates=None):
     """Decorator defining a function / method as optset choice"""
 
     if applies is not None:
@@ -1284,4 +3425,7 @@ def optset(flags=None, options=None, int_options=None, float_options=None,
             raise OptionMatcherException('Invalid applies value: ' + applies)
 
     return Decoration.decorate(True, flags, options, int_options,
-                               float_options, prefixes, priority, applies)
+                               float_options, prefixes, priority, applies,
+                               raw_options, converters, varargs,
+                               count_flags, multi_options, dict_prefixes,
+                               duplicates)
@@ -0,0 +1,221 @@
+"""Benchmarks for optmatch, run as: python benchmarks.py
+They are not part of the tests, just report the timings on this machine
+"""
+
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from optmatch import CommandLine, OptionMatcher, optmatcher, optset
+
+
+class Cluster(OptionMatcher):
+
+    @optset(flags='q')
+    def set_quiet(self, q=False):
+        self.quiet = q
+
+    @optmatcher(count_flags='v, d', options='o')
+    def handle(self, file, v=0, d=0, o=None):
+        return v + d
+
+
+def report(name, function, number):
+    best = min(timeit.repeat(function, number=number, repeat=5))
+    print('%-40s %10.2f us' % (name, best * 1e6 / number))
+
+
+def benchmark_short_clusters():
+    """Long clusters of short flags, like -vvdvd..., in getopt mode,
+    decoded with the short options table and handler by handler"""
+    matcher = Cluster()
+    plan = matcher._get_plan()
+    handler = plan.matchers[0]
+    handlers = [handler] + plan.get_applicable_commons(handler)
+    for length in (8, 64, 512):
+        args = [None, '-q' + 'vd' * (length // 2) + 'oout', 'file']
+
+        def by_table():
+            plan.reset()
+            plan.get_routes(handler).feed(CommandLine(args, matcher._mode,
+                                                      False))
+
+        def by_handlers():
+            plan.reset()
+            matcher._feed_handlers(handlers, CommandLine(args, matcher._mode,
+                                                         False))
+
+        report('cluster of %d, table' % length, by_table, 2000)
+        report('cluster of %d, handlers' % length, by_handlers, 2000)
+        report('cluster of %d, process' % length,
+               lambda: matcher.process(args), 2000)
+
+
+def create_optsets_matcher(optsets):
+    """Creates a matcher with the given number of optsets, each with its
+    own flag and option"""
+    source = ['class Optsets(OptionMatcher):',
+              '    @optmatcher',
+              '    def handle(self, file):',
+              '        return file']
+    for i in range(optsets):
+        source.extend(['    @optset',
+                       '    def set_%d(self, flag%d_flag=False, '
+                       'option%d_option=None):' % (i, i, i),
+                       '        pass'])
+    namespace = {'OptionMatcher': OptionMatcher, 'optmatcher': optmatcher,
+                 'optset': optset}
+    exec('\n'.join(source), namespace)
+    return namespace['Optsets']()
+
+
+def benchmark_routes():
+    """Long options owned by the last of many optsets, routed directly
+    to it, or offered to each handler in turn"""
+    for optsets in (4, 32):
+        matcher = create_optsets_matcher(optsets)
+        plan = matcher._get_plan()
+        handler = plan.matchers[0]
+        handlers = [handler] + plan.get_applicable_commons(handler)
+        last = optsets - 1
+        args = [None, '--flag%d' % last, '--option%d=x' % last, 'file']
+
+        def by_routes():
+            plan.reset()
+            plan.get_routes(handler).feed(CommandLine(args, matcher._mode,
+                                                      False))
+
+        def by_handlers():
+            plan.reset()
+            matcher._feed_handlers(handlers, CommandLine(args, matcher._mode,
+                                                         False))
+
+        report('%d optsets, routes' % optsets, by_routes, 5000)
+        report('%d optsets, handlers' % optsets, by_handlers, 5000)
+
+
+def benchmark_prefilter():
+    """Many matchers, each one requiring its own flag: the matchers are
+    skipped using the arguments summary, or tried one by one"""
+    source = ['class Commands(OptionMatcher):']
+    for i in range(64):
+        source.extend(['    @optmatcher',
+                       '    def handle_%d(self, file, command%d_flag):' %
+                       (i, i),
+                       '        return %d' % i])
+    namespace = {'OptionMatcher': OptionMatcher, 'optmatcher': optmatcher}
+    exec('\n'.join(source), namespace)
+    matcher = namespace['Commands']()
+    plan = matcher._get_plan()
+    args = [None, '--command63', 'file']
+
+    def find(summarize):
+        plan.reset()
+        command_line = CommandLine(args, matcher._mode, False)
+        matcher._find_matcher(plan, plan.matchers, command_line,
+                              summarize and command_line.summarize())
+
+    report('64 matchers, pre-filter', lambda: find(True), 2000)
+    report('64 matchers, no pre-filter', lambda: find(False), 2000)
+
+
+def report_allocations(name, function, number):
+    """Reports the memory allocated on each call, as the peak traced
+    by tracemalloc over the memory in use before the call"""
+    function()  # warm up: plan, generated code, pooled state
+    tracemalloc.start()
+    total = 0
+    for i in range(number):
+        tracemalloc.stop()
+        tracemalloc.start()
+        function()
+        total += tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('%-40s %10d bytes' % (name, total // number))
+
+
+def benchmark_pooling():
+    """Processing repeatedly the same command line, allocating the
+    handlers' state on each call, or reusing it"""
+    args = [None, '-q', '-vvd', '-o', 'out', 'file']
+    for pooling in (False, True):
+        matcher = Cluster().enable_pooling(pooling)
+        name = 'process, %s' % ('pooled' if pooling else 'not pooled')
+        report(name, lambda: matcher.process(args), 5000)
+        report_allocations(name, lambda: matcher.process(args), 1000)
+
+
+def benchmark_parse():
+    """Parsed values as the matcher's result object, compared with a
+    dictionary: creation, attribute access and size"""
+    matcher = Cluster()
+    args = [None, '-q', '-vvd', '-o', 'out', 'file']
+    result = matcher.parse(args)
+    values = result.as_dict()
+    report('parse', lambda: matcher.parse(args), 5000)
+    report('process', lambda: matcher.process(args), 5000)
+    report('result, access', lambda: result.file, 100000)
+    report('dict, access', lambda: values['file'], 100000)
+    print('%-40s %10d bytes' % ('result, size', sys.getsizeof(result)))
+    print('%-40s %10d bytes' % ('dict, size', sys.getsizeof(values)))
+
+
+def benchmark_spec():
+    """Many matchers -each with its own command, flag and option-, defined
+    on a spec, as lazy matchers with signature (on stub functions), or as
+    decorated methods: time to define them, and to build the plan"""
+    commands = 1000
+    spec = {'matchers': [{'name': 'handle_%d' % i, 'command': 'cmd%d' % i,
+                          'parameters': ['file', 'force', 'mode'],
+                          'defaults': {'force': False, 'mode': None},
+                          'flags': ['force'], 'options': ['mode'],
+                          'target': 'module:handle_%d' % i}
+                         for i in range(commands)]}
+
+    def by_spec():
+        return OptionMatcher().add_spec(spec)
+
+    def by_signature():
+        matcher = OptionMatcher()
+        for i in range(commands):
+            matcher.add_lazy_matcher('module:handle_%d' % i,
+                                     'file, force=False, mode=None',
+                                     flags='force', options='mode',
+                                     command='cmd%d' % i)
+        return matcher
+
+    def by_decoration():
+        source = ['class Commands(OptionMatcher):']
+        for i in range(commands):
+            source.extend(["    @optmatcher(flags='force', options='mode', "
+                           "command='cmd%d')" % i,
+                           '    def handle_%d(self, file, force=False, '
+                           'mode=None):' % i,
+                           '        pass'])
+        namespace = {'OptionMatcher': OptionMatcher, 'optmatcher': optmatcher}
+        exec('\n'.join(source), namespace)
+        return namespace['Commands']()
+
+    for name, define in (('spec', by_spec), ('signatures', by_signature),
+                         ('decorated', by_decoration)):
+        matcher = define()
+
+        def build():
+            matcher._plan = None
+            matcher._get_plan()
+
+        report('%d commands, %s, define' % (commands, name), define, 1)
+        report('%d commands, %s, plan' % (commands, name), build, 1)
+
+
+if __name__ == '__main__':
+    benchmark_short_clusters()
+    benchmark_routes()
+    benchmark_prefilter()
+    benchmark_pooling()
+    benchmark_parse()
+    benchmark_spec()
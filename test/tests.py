@@ -1,11 +1,36 @@
 # note that testing source version can be easily done as:
 # (export PYTHONPATH=../src/:$PYTHONPATH && python tests.py BugTests.bug000)
 
+import array
+import gc
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
+try:
+    from shutil import which
+except ImportError:  # python 2
+    from distutils.spawn import find_executable as which
+try:
+    from StringIO import StringIO  # python 2
+except ImportError:
+    from io import StringIO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from optmatch import CommandLine, OptMatcherHandler, UsageMode
 from optmatch import OptionMatcher, UsageException, OptionMatcherException
-from optmatch import optmatcher, optset
+from optmatch import optmatcher, optset, register_converter, ListConverter
+from optmatch import call_server, _INT_TYPECODE
 
 
 class Tests(unittest.TestCase):
@@ -134,6 +159,46 @@ class InternalTests(Tests):
         ch = OptMatcherHandler(method, UsageMode('-', '='))
         self.assertEqual(ch.invoke(), "Called")
 
+    def test0031(self):
+        """Option values expansion is memoized per command line"""
+
+        def method(aOption): pass
+
+        os.environ['OPTMATCH_TEST'] = 'value'
+        try:
+            m = UsageMode('-', '=')
+            arg = CommandLine([None, '-a=$OPTMATCH_TEST'], m, False)
+            ch = OptMatcherHandler(method, m)
+            ret = ch.handle_arg(arg)
+            self.assertTrue(not ret and ch.provided[1] == 'value')
+            self.assertEqual({'$OPTMATCH_TEST': 'value'}, arg.expanded)
+            # %VAR% is expanded on windows
+            arg.expand('%OPTMATCH_TEST%')
+            self.assertIn('%OPTMATCH_TEST%', arg.expanded)
+        finally:
+            del os.environ['OPTMATCH_TEST']
+
+    def test0032(self):
+        """Provided parameters are tracked as a bitmask"""
+
+        @optmatcher(flags='q, orphan', prefixes='D')
+        def method(q, D): pass
+
+        m = UsageMode('-', '=')
+        ch = OptMatcherHandler(method, m)
+        self.assertEqual(0, ch.provided_mask)
+        self.assertEqual('Missing required flag q', ch.check_invokable(True))
+        self.assertFalse(ch.check_invokable(False))
+        arg = CommandLine([None, '-orphan', '-Da=1'], m, False)
+        while not arg.finished():
+            self.assertFalse(ch.handle_arg(arg))
+        self.assertTrue(ch.is_provided(-1) and ch.is_provided(2))
+        self.assertFalse(ch.is_provided(1))
+        self.assertEqual([('a', '1')], ch.provided[2])
+        self.assertEqual('Missing required flag q', ch.check_invokable(False))
+        ch.reset()
+        self.assertEqual((0, []), (ch.provided_mask, ch.provided[2]))
+
     def test0101(self):
         """Non getopt mode. Long flag with alias"""
 
@@ -459,6 +524,20 @@ class InternalTests(Tests):
         self.assertTrue(not ch.handle_arg(arg) and not ch.handle_arg(arg)
                         and arg.finished())
 
+    def test0606(self):
+        """getopt mode. Typed vararg stored into an array"""
+
+        def method(*var): pass
+
+        m = UsageMode('--', '=')
+        method.__annotations__ = {'var': 'int'}
+        arg = CommandLine([None, '1', '2'], m, False)
+        ch = OptMatcherHandler(method, m)
+        self.assertTrue(not ch.handle_arg(arg) and not ch.handle_arg(arg))
+        self.assertEqual([1, 2], ch._get_invoking_pars()[1])
+        self.assertEqual(array.array(_INT_TYPECODE, [1, 2]),
+                         ch.converted_vararg[1])
+
     def test0611(self):
         """getopt mode. Checking gnu mode"""
 
@@ -1494,6 +1573,122 @@ class OptMatcherTests(Tests):
 
         self.assertTrue(Simple().process([None, '-v']))
 
+    def test2212(self):
+        """Applicability of the optsets, computed with the plan"""
+
+        class Simple(OptionMatcher):
+
+            @optset(applies='handle2, handle3')
+            def set(self, vFlag):
+                pass
+
+            @optset(priority=1)
+            def set_quiet(self, qFlag):
+                pass
+
+            @optmatcher(exclusive=True)
+            def handle1(self): return False
+
+            @optmatcher
+            def handle2(self, oOption): return True
+
+            @optmatcher
+            def handle3(self): return True
+
+        self.assertEqual({'handle1': [], 'handle2': ['set_quiet', 'set'],
+                          'handle3': ['set_quiet', 'set']},
+                         Simple().get_applicable_optsets())
+
+    def test2213(self):
+        """Arguments routed to the first handler accepting them"""
+
+        class Simple(OptionMatcher):
+
+            @optset
+            def set(self, verbose_flag=False, DPrefix=None, *args, **kwargs):
+                self.common = verbose_flag, DPrefix, args, kwargs
+
+            @optset(priority=1)
+            def set_first(self, verbose_flag=False, DefinePrefix=None):
+                self.first = verbose_flag, DefinePrefix
+
+            @optmatcher
+            def handle(self, file, verbose_flag=False):
+                return file, verbose_flag, self.first, self.common
+
+        self.assertEqual(('a', True, (False, [('x', '2')]),
+                          (False, [('y', '3')], ('b', 'c'), {'other': '1'})),
+                         Simple(option_prefix='-').process(
+                             [None, '-verbose', '-other=1', '-Definex=2',
+                              '-Dy=3', 'a', 'b', 'c']))
+        self.assertRaiseArg(UsageException, 'Unexpected argument: --other=1',
+                            Simple().process, [None, '--other=1', 'a'],
+                            handle_usage_problems=False)
+
+    def test2214(self):
+        """Matchers accepting the options are tried, even if they fail"""
+
+        tried = []
+
+        def convert(value):
+            tried.append(value)
+            return value
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(priority=2, converters={'mode_option': convert})
+            def handle_copy(self, source, target, copy_flag, mode_option=0):
+                return 'copy'
+
+            @optmatcher(priority=1, converters={'mode_option': convert})
+            def handle_many(self, a, b, c, mode_option=0):
+                return 'many'
+
+            @optmatcher
+            def handle(self, file, mode_option=0):
+                return 'one'
+
+        self.assertEqual('one', Simple().process([None, '--mode=1', 'a']))
+        self.assertEqual(['1', '1'], tried)
+        del tried[:]
+        self.assertRaiseArg(UsageException, 'Unexpected argument: b',
+                            Simple().process, [None, '--mode=1', 'a', 'b'],
+                            handle_usage_problems=False)
+        self.assertEqual(['1', '1'], tried)
+
+    def test2215(self):
+        """Gnu mode, after a matcher failing on non option arguments"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(priority=1)
+            def handle_first(self, file, quiet_flag=False):
+                return 'first'
+
+            @optmatcher
+            def handle(self, file, other, quiet_flag=False):
+                return 'second'
+
+        self.assertEqual('second', Simple().process([None, '--quiet', 'a',
+                                                     'b'], gnu=True))
+
+    def test2216(self):
+        """A matcher rejecting an option value is not skipped"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(priority=1)
+            def handle_mode(self, mode_option, verbose_flag=False):
+                return 'mode'
+
+            @optmatcher
+            def handle(self, verbose_option):
+                return 'verbose'
+
+        self.assertRaiseArg(UsageException, 'Incorrect flag verbose',
+                            Simple().process, [None, '--verbose=3'],
+                            handle_usage_problems=False)
+
 
 class OptMatcherTestsOnDecoration(Tests):
     """Tests on the OptionMatcher decorators"""
@@ -1682,6 +1877,134 @@ class OptMatcherTestsOnDecoration(Tests):
                             Simple().process, [None],
                             handle_usage_problems=False)
 
+    def test3024(self):
+        """Raw options are not expanded, normal options are"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(options='path', raw_options='pattern')
+            def handle(self, path, pattern):
+                return path, pattern
+
+        os.environ['OPTMATCH_TEST'] = 'value'
+        try:
+            self.assertEqual(('value', '$OPTMATCH_TEST'),
+                             Simple().process([None, '--path=$OPTMATCH_TEST',
+                                               '--pattern=$OPTMATCH_TEST']))
+        finally:
+            del os.environ['OPTMATCH_TEST']
+
+    def test3025(self):
+        """Converters by name, including list options"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(options='ids, ratio',
+                        converters={'ids': 'int_list', 'ratio': 'float'})
+            def handle(self, ids, ratio):
+                return ids, ratio
+
+        ids, ratio = Simple().process([None, '--ids=1,2,3', '--ratio=0.5'])
+        self.assertEqual(array.array(_INT_TYPECODE, [1, 2, 3]), ids)
+        self.assertEqual(0.5, ratio)
+
+    def test3026(self):
+        """Converters as python annotations, also on naming convention"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher
+            def handle(self, ids_option, names_option):
+                return ids_option, names_option
+
+        Simple.__dict__['handle'].__annotations__ = {
+            'ids_option': ListConverter(int, separator=':'),
+            'names_option': 'raw_list'}
+
+        self.assertEqual(([1, 2], ['$a', 'b']),
+                         Simple().process([None, '--ids=1:2',
+                                           '--names=$a,b']))
+
+    def test3027(self):
+        """Registered converters, with invalid values"""
+
+        register_converter('upper', lambda x: x.upper())
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(converters={'mode_option': 'upper',
+                                    'ids_option': 'int_list'})
+            def handle(self, mode_option, ids_option=None):
+                return mode_option
+
+        self.assertEqual('FAST', Simple().process([None, '--mode=fast']))
+        self.assertRaiseArg(UsageException, 'Incorrect value for ids',
+                            Simple().process, [None, '--mode=fast',
+                                               '--ids=1,a'],
+                            handle_usage_problems=False)
+
+    def test3028(self):
+        """Converters must be defined on known options"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(converters={'mode': 'int'})
+            def handle(self, mode):
+                pass
+
+        self.assertRaiseArg(OptionMatcherException,
+                            'method Simple.handle: Invalid converter '
+                            'target: mode',
+                            Simple().process, [None, 'fast'])
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(converters={'mode_option': 'unknown'})
+            def handle(self, mode_option):
+                pass
+
+        self.assertRaiseArg(OptionMatcherException,
+                            'method Simple.handle: Invalid converter: '
+                            'unknown',
+                            Simple().process, [None, '--mode=fast'])
+
+    def test3029(self):
+        """Typed varargs, converted in bulk"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(varargs='int')
+            def handle(self, first, *ids):
+                return first, ids
+
+        self.assertEqual(('a', (1, 2, 3)),
+                         Simple().process([None, 'a', '1', '2', '3']))
+        self.assertRaiseArg(UsageException, 'Incorrect value for argument x',
+                            Simple().process, [None, 'a', '1', 'x'],
+                            handle_usage_problems=False)
+
+    def test3030(self):
+        """Typed varargs, as annotation"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher
+            def handle(self, *values):
+                return values
+
+        Simple.__dict__['handle'].__annotations__ = {'values': float}
+        self.assertEqual((1.5, 2.0), Simple().process([None, '1.5', '2']))
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(varargs='int')
+            def handle(self, values):
+                return values
+
+        self.assertRaiseArg(OptionMatcherException,
+                            'method Simple.handle: Invalid varargs converter',
+                            Simple().process, [None, '1'])
+
     def test3031(self):
         """Full decoration"""
 
@@ -1781,6 +2104,420 @@ class OptMatcherTestsOnDecoration(Tests):
 
         self.assertFalse(Simple().process([None, '-ok']))
 
+    def test3051(self):
+        """Decorated methods are collected on the class, not the instance"""
+
+        class Base(OptionMatcher):
+
+            @optmatcher
+            def handle(self, file):
+                return 'base', file
+
+            @optmatcher
+            def handle_copy(self, file, copy_flag):
+                return 'copy', file
+
+            @property
+            def failing(self):
+                raise AssertionError('property accessed')
+
+        class Simple(Base):
+
+            handle_copy = None
+
+            @optmatcher(priority=1)
+            def handle_move(self, file, move_flag):
+                return 'move', file
+
+        self.assertEqual(('move', 'a'),
+                         Simple().process([None, '--move', 'a']))
+        self.assertEqual(('base', 'a'), Simple().process([None, 'a']))
+        self.assertRaises(UsageException, Simple().process,
+                          [None, '--copy', 'a'], handle_usage_problems=False)
+        self.assertEqual(('copy', 'a'), Base().process([None, '--copy', 'a']))
+
+    def test3052(self):
+        """List options whose elements cannot be stored in the array"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(options='ids', converters={'ids': 'int_list'})
+            def handle(self, ids):
+                return ids
+
+        self.assertRaiseArg(UsageException, 'Incorrect value for ids',
+                            Simple().process,
+                            [None, '--ids=1,99999999999999999999999'],
+                            handle_usage_problems=False)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not available')
+    def test3053(self):
+        """List options stored into NumPy arrays"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(options='ids', converters={'ids': ListConverter(
+                lambda x: int(x) * 2, typecode='l', use_numpy=True)})
+            def handle(self, ids):
+                return ids
+
+        self.assertEqual([2, 4], list(Simple().process([None, '--ids=1,2'])))
+        self.assertRaiseArg(UsageException, 'Incorrect value for ids',
+                            Simple().process,
+                            [None, '--ids=1,99999999999999999999999'],
+                            handle_usage_problems=False)
+
+    def test3054(self):
+        """Counting flags"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(count_flags='verbose as v')
+            def handle(self, file, verbose=0):
+                return verbose
+
+        self.assertEqual(0, Simple().process([None, 'file']))
+        self.assertEqual(3, Simple().process([None, '-vvv', 'file']))
+        self.assertEqual(2, Simple(aliases={'v': 'verbose'}).process(
+            [None, '--verbose', 'file', '-v']))
+
+    def test3055(self):
+        """Repeatable options"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(multi_options='include, level',
+                        converters={'level': 'int'})
+            def handle(self, include, level=None):
+                return include, level
+
+        self.assertEqual((['a', 'b'], array.array(_INT_TYPECODE, [1, 2])),
+                         Simple().process([None, '--include=a', '--level=1',
+                                           '--include', 'b', '--level=2']))
+        self.assertEqual((['a'], None),
+                         Simple().process([None, '--include=a']))
+        self.assertRaiseArg(UsageException, 'Missing required option include',
+                            Simple(default_help=False).process,
+                            [None, '--level=1'], handle_usage_problems=False)
+
+    def test3056(self):
+        """Prefixes given as dictionaries, default duplicates policy"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(dict_prefixes='D')
+            def handle(self, D):
+                return D
+
+        self.assertEqual({'a': '1', 'b': None},
+                         Simple().process([None, '-Da=2', '-Db', '-D',
+                                           'a=1']))
+        self.assertEqual({}, Simple().process([None]))
+
+    def test3057(self):
+        """Prefixes given as dictionaries, with duplicates policies"""
+
+        def create(policy):
+            class Simple(OptionMatcher):
+
+                @optmatcher(dict_prefixes='D', duplicates=policy)
+                def handle(self, D):
+                    return D
+
+            return Simple()
+
+        args = [None, '-Da=2', '-Db', '-Da=1']
+        self.assertEqual({'a': '2', 'b': None}, create('first').process(args))
+        self.assertEqual({'a': ['2', '1'], 'b': [None]},
+                         create('collect').process(args))
+        self.assertRaiseArg(UsageException, 'Duplicated prefix definition a',
+                            create('error').process, args,
+                            handle_usage_problems=False)
+        self.assertRaiseArg(OptionMatcherException,
+                            'method Simple.handle: Invalid duplicates '
+                            'policy: any',
+                            create('any').process, args)
+
+    def test3066(self):
+        """Duplicates policies given per prefix, and without dict prefixes"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(dict_prefixes='D, define', prefixes='U',
+                        duplicates={'define': 'error'})
+            def handle(self, D, U, define):
+                return D, U, define
+
+        self.assertEqual(({'a': '1'}, [('b', '1'), ('b', '2')], {'a': '3'}),
+                         Simple().process([None, '-Da=2', '-Da=1', '-Ub=1',
+                                           '-Ub=2', '--definea=3']))
+        self.assertRaiseArg(UsageException, 'Duplicated prefix definition a',
+                            Simple().process, [None, '--definea=2',
+                                               '--definea=1'],
+                            handle_usage_problems=False)
+        plan = Simple().export_plan()
+        self.assertEqual({'1': 'last', '3': 'error'},
+                         plan['matchers'][0]['duplicates'])
+        self.assertRaiseArg(UsageException, 'Duplicated prefix definition a',
+                            Simple().load_plan(plan).process,
+                            [None, '--definea=2', '--definea=1'],
+                            handle_usage_problems=False)
+
+        def create(**decoration):
+            class Simple(OptionMatcher):
+
+                @optmatcher(**decoration)
+                def handle(self, D, U):
+                    return D
+
+            return Simple()
+
+        for decoration, problem in (
+                ({'prefixes': 'D, U', 'duplicates': 'first'},
+                 'Duplicates policy without dict_prefixes'),
+                ({'dict_prefixes': 'D', 'prefixes': 'U',
+                  'duplicates': {'U': 'first'}},
+                 'Invalid duplicates target: U'),
+                ({'dict_prefixes': 'D', 'prefixes': 'U',
+                  'duplicates': {'D': 'any'}},
+                 'Invalid duplicates policy: any')):
+            self.assertRaiseArg(OptionMatcherException,
+                                'method Simple.handle: ' + problem,
+                                create(**decoration).process, [None])
+
+    def test3058(self):
+        """Short clusters decoded across the matcher and its optsets"""
+
+        class Simple(OptionMatcher):
+
+            @optset(flags='q, v', int_options='level as l')
+            def set_options(self, q=False, v=False, level=0):
+                self.common = q, v, level
+
+            @optmatcher(count_flags='v', options='o')
+            def handle(self, file, v=0, o=None):
+                return self.common, file, v, o
+
+        self.assertEqual(((True, False, 2), 'x', 1000, 'out'),
+                         Simple().process([None, '-q' + 'v' * 1000 + 'l2',
+                                           '-oout', 'x']))
+        self.assertEqual(((False, False, 0), 'x', 2, 'out'),
+                         Simple().process([None, '-vvo', 'out', 'x']))
+        self.assertRaiseArg(UsageException, 'Unexpected flag z in argument '
+                            '-vvzq', Simple().process, [None, '-vvzq', 'x'],
+                            handle_usage_problems=False)
+
+    def test3059(self):
+        """Unique abbreviations of long options"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(flags='verbose, version', options='output',
+                        prefixes='define')
+            def handle(self, file, verbose=False, version=False,
+                       output=None, define=None):
+                return file, verbose, version, output, define
+
+        simple = Simple(aliases={'o': 'output'}).enable_abbreviations()
+        self.assertEqual(('x', True, False, 'out', [('a', '1')]),
+                         simple.process([None, '--verb', '--out=out',
+                                         '--definea=1', 'x']))
+        self.assertEqual(('x', False, True, 'out', []),
+                         simple.process([None, '--vers', '--o', 'out', 'x']))
+        self.assertRaiseArg(UsageException, 'Ambiguous option --ver: '
+                            '--verbose, --version', simple.process,
+                            [None, '--ver', 'x'], handle_usage_problems=False)
+        self.assertRaiseArg(UsageException, 'Unexpected argument: --verb',
+                            Simple().process, [None, '--verb', 'x'],
+                            handle_usage_problems=False)
+
+    def test3060(self):
+        """Pooled state, reused on each process call"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(flags='verbose', prefixes='define',
+                        multi_options='include')
+            def handle(self, file, verbose=False, define=None,
+                       include=None):
+                return file, verbose, define, include
+
+        simple = Simple().enable_pooling()
+        first = simple.process([None, '--verbose', '--definea=1',
+                                '--include=i', 'x'])
+        self.assertEqual(('x', True, [('a', '1')], ['i']), first)
+        command_line = simple._get_plan().command_line
+        second = simple.process([None, '--defineb=2', '--include=j', 'y'])
+        self.assertEqual(('y', False, [('b', '2')], ['j']), second)
+        # the containers are reused, the parsed command line as well
+        self.assertTrue(first[2] is second[2] and first[3] is second[3])
+        self.assertTrue(command_line is simple._get_plan().command_line)
+        self.assertEqual(('z', False, [], None),
+                         simple.process([None, 'z']))
+        self.assertEqual(None, Simple()._get_plan().command_line)
+
+    def test3061(self):
+        """Parse returns the values of the matcher, without invoking it"""
+
+        class Simple(OptionMatcher):
+
+            @optset(flags='quiet')
+            def set_quiet(self, quiet=False):
+                self.quiet = quiet
+
+            @optmatcher(count_flags='verbose', prefixes='define')
+            def handle(self, file, verbose=0, define=None, *args):
+                raise AssertionError('invoked')
+
+            @optmatcher(flags='version')
+            def show_version(self, version):
+                raise AssertionError('invoked')
+
+        simple = Simple()
+        ret = simple.parse([None, '--quiet', '--verbose', '--verbose',
+                            '--definea=1', 'x', 'y'])
+        self.assertEqual('handle', type(ret).__name__)
+        self.assertEqual(('x', 2, [('a', '1')], ('y',)),
+                         (ret.file, ret.verbose, ret.define, ret.args))
+        self.assertEqual({'file': 'x', 'verbose': 2, 'define': [('a', '1')],
+                          'args': ('y',)}, ret.as_dict())
+        self.assertTrue(simple.quiet)
+        self.assertFalse(hasattr(ret, '__dict__'))
+        ret2 = simple.parse([None, 'z'])
+        self.assertTrue(type(ret) is type(ret2))
+        self.assertEqual("handle(file='z', verbose=0, define=[], args=())",
+                         repr(ret2))
+        self.assertEqual(True, simple.parse([None, '--version']).version)
+        self.assertRaiseArg(UsageException, 'Unexpected argument: --other',
+                            simple.parse, [None, '--other'],
+                            handle_usage_problems=False)
+
+    def test3062(self):
+        """Matchers defined on a spec, without functions to inspect"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(count_flags='verbose', multi_options='include',
+                        options='output', priority=2)
+            def handle(self, file, verbose=0, include=None, output='a.out'):
+                return file, verbose, include, output
+
+        calls = []
+        spec = {'matchers': [{'name': 'handle',
+                              'function': lambda *args: args,
+                              'parameters': ['file', 'verbose', 'include',
+                                             'output'],
+                              'defaults': {'verbose': 0, 'include': None,
+                                           'output': 'a.out'},
+                              'count_flags': ['verbose'],
+                              'multi_options': 'include',
+                              'options': 'output', 'priority': 2},
+                             {'name': 'copy', 'command': 'copy',
+                              'parameters': 'source, target, force',
+                              'flags': 'force'}],
+                'optsets': [{'name': 'set_quiet', 'parameters': ['quiet'],
+                             'flags': 'quiet', 'defaults': {'quiet': False},
+                             'function': calls.append}],
+                'aliases': {'v': 'verbose'}}
+        simple = OptionMatcher().add_spec(spec)
+        # the same tables are built as for the decorated method
+        self.assertEqual(Simple(aliases={'v': 'verbose'})
+                         ._get_plan().matchers[0].export(),
+                         simple._get_plan().matchers[0].export())
+        self.assertEqual(('x', 2, ['a'], 'a.out'),
+                         simple.process([None, '-vv', '--include=a', 'x',
+                                         '--quiet']))
+        self.assertEqual("copy(source='a', target='b', force=True)",
+                         repr(simple.parse([None, 'copy', '--force', 'a',
+                                            'b'])))
+        self.assertEqual([True, False], calls)
+        self.assertRaiseArg(OptionMatcherException, 'No function defined '
+                            'for copy, only parsing', simple.process,
+                            [None, 'copy', '--force', 'a', 'b'])
+        self.assertRaiseArg(OptionMatcherException, 'function copy: Invalid '
+                            'default: other', OptionMatcher().add_spec(
+                                {'matchers': [{'name': 'copy',
+                                               'defaults': {'other': 1}}]})
+                            .process, [None])
+        self.assertRaiseArg(OptionMatcherException, 'Invalid spec for copy',
+                            OptionMatcher().add_spec, {'matchers': [
+                                {'name': 'copy', 'unknown': 1}]})
+
+    def test3063(self):
+        """Spec parameters must be unique python identifiers"""
+
+        for parameters in ['file-name', 'class', 'source, source', 'a,,b',
+                           ' ', ['source', 1], 3]:
+            simple = OptionMatcher().add_spec({'matchers': [
+                {'name': 'copy', 'parameters': parameters}]})
+            self.assertRaiseArg(OptionMatcherException,
+                                'Invalid spec for copy', simple.parse, [None])
+        simple = OptionMatcher().add_spec({'matchers': [
+            {'name': 'copy', 'parameters': ['self', '_target']}]})
+        self.assertEqual({'self': 'a', '_target': 'b'},
+                         simple.parse([None, 'a', 'b']).as_dict())
+
+    def test3065(self):
+        """Decorated attributes set on the instance, or later on the class"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher
+            def handle(self, file):
+                return 'handle', file
+
+            @optmatcher(flags='move')
+            def handle_move(self, file, move):
+                return 'move', file
+
+        @optmatcher(flags='copy')
+        def handle_copy(file, copy):
+            return 'copy', file
+
+        simple = Simple()
+        simple.handle_copy = handle_copy
+        simple.handle_move = None
+        self.assertEqual(('copy', 'a'),
+                         simple.process([None, '--copy', 'a']))
+        self.assertRaises(UsageException, simple.process,
+                          [None, '--move', 'a'], handle_usage_problems=False)
+        self.assertEqual(('move', 'a'),
+                         Simple().process([None, '--move', 'a']))
+
+        @optmatcher(flags='late')
+        def handle_late(self, file, late):
+            return 'late', file
+
+        Simple.handle_late = handle_late
+        self.assertEqual(('late', 'a'),
+                         Simple().process([None, '--late', 'a']))
+
+    def test3064(self):
+        """Typed varargs: parse keeps the array, bad values are reported"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(varargs=ListConverter(int, typecode='b'))
+            def handle(self, first, *ids):
+                return first, ids
+
+            @optmatcher(command='raw', varargs='raw')
+            def handle_raw(self, *values):
+                return values
+
+        simple = Simple()
+        ids = simple.parse([None, 'a', '1', '2']).ids
+        self.assertEqual(array.array('b', [1, 2]), ids)
+        self.assertEqual(array.array('b'), simple.parse([None, 'a']).ids)
+        self.assertEqual(('a', (1, 2)), simple.process([None, 'a', '1', '2']))
+        self.assertEqual(('x', 'y'), simple.parse([None, 'raw', 'x',
+                                                   'y']).values)
+        for args, culprit in ((['300', '2'], '300'), (['1', 'x'], 'x')):
+            self.assertRaiseArg(UsageException,
+                                'Incorrect value for argument ' + culprit,
+                                simple.process, [None, 'a'] + args,
+                                handle_usage_problems=False)
+
 
 class OptMatcherTestsOnErrorMessages(Tests):
     """Tests on the OptionMatcher error messages"""
@@ -1885,6 +2622,765 @@ class OptMatcherTestsOnErrorMessages(Tests):
                             handle_usage_problems=False)
 
 
+class CompletionTests(Tests):
+    """Tests on the OptionMatcher completion"""
+
+    class Simple(OptionMatcher):
+
+        @optmatcher(flags='verbose', options='mode')
+        def handle_move(self, file, target, verbose=False, mode='fast'):
+            pass
+
+        @optmatcher(flags='compress', prefixes='D')
+        def handle_compress(self, file, compress, D):
+            raise Exception('Handler invoked')
+
+    def test5001(self):
+        """Completion of long options, getopt mode"""
+
+        self.assertEqual(['--compress', '--mode=', '--mode=fast',
+                          '--verbose'],
+                         self.Simple().complete([None, 'file', '--']))
+        self.assertEqual(['--compress', '--help', '--mode=', '--mode=fast',
+                          '--verbose', '-D', '-h'],
+                         self.Simple().complete([None, '-']))
+
+    def test5002(self):
+        """Completion prunes incompatible matchers"""
+
+        matcher = self.Simple()
+        self.assertEqual(['--mode=', '--mode=fast'],
+                         matcher.complete([None, '--verbose', '--mo']))
+        self.assertEqual(['-D'],
+                         matcher.complete([None, '--compress', 'f', '-']))
+        self.assertEqual([], matcher.complete([None, 'a', 'b', 'c', '-']))
+
+    def test5003(self):
+        """Completion of values, and cursor position"""
+
+        matcher = self.Simple(aliases={'m': 'mode'})
+        self.assertEqual(['fast'], matcher.complete([None, '-m', '']))
+        self.assertEqual(['fast'], matcher.complete([None, '--mode', 'f']))
+        self.assertEqual(['--compress'],
+                         matcher.complete([None, '--c', 'file'], 1))
+
+    def test5004(self):
+        """Completion in non getopt mode"""
+
+        matcher = self.Simple(option_prefix='/', assigner=':')
+        self.assertEqual(['/mode:', '/mode:fast'],
+                         matcher.complete([None, '/verbose', '/m']))
+
+    def test5005(self):
+        """Processing again from an optset does not share the handlers"""
+
+        class Simple(OptionMatcher):
+
+            @optset(options='nested')
+            def set_nested(self, nested=None):
+                self.nested = nested and self.process([None, nested])
+
+            @optmatcher(options='mode')
+            def handle(self, file, mode='outer'):
+                return mode, file
+
+        simple = Simple()
+        self.assertEqual(('outer', 'outerfile'),
+                         simple.process([None, '--nested=other',
+                                         'outerfile']))
+        self.assertEqual(('outer', 'other'), simple.nested)
+        self.assertEqual(('inner', 'file'),
+                         simple.process([None, '--mode=inner', 'file']))
+
+    def test5006(self):
+        """The same instance can process on multiple threads"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(options='mode')
+            def handle(self, file, mode='fast'):
+                return mode, file
+
+            @optmatcher(flags='quiet')
+            def handle_copy(self, source, target, quiet=False):
+                return source, target
+
+        simple, errors = Simple(), []
+
+        def run(name):
+            for i in range(500):
+                if i % 2:
+                    args = [None, '--mode=' + name, str(i)]
+                else:
+                    args = [None, name, str(i)]
+                try:
+                    ret = simple.process(args, handle_usage_problems=False)
+                    if ret != (name, str(i)):
+                        errors.append(ret)
+                except UsageException as ex:
+                    errors.append(ex)
+
+        # the threads are switched as often as possible
+        if hasattr(sys, 'setswitchinterval'):
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        else:  # python 2
+            interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+        threads = [threading.Thread(target=run, args=('t%d' % i,))
+                   for i in range(8)]
+        try:
+            for each in threads:
+                each.start()
+            for each in threads:
+                each.join()
+        finally:
+            if hasattr(sys, 'setswitchinterval'):
+                sys.setswitchinterval(interval)
+            else:
+                sys.setcheckinterval(interval)
+        self.assertEqual([], errors)
+
+    def test5011(self):
+        """Completion script: the option set matches the plan"""
+
+        matcher = self.Simple(aliases={'m': 'mode', 'v': 'verbose'})
+        script = matcher.get_completion_script('my-tool')
+        words = re.search('words=\\((.*)\\)', script).group(1)
+        expected = set()
+        plan = matcher._get_plan()
+        for handler in plan.matchers + plan.commons:
+            for name in handler.defs | handler.short_defs:
+                word = ('-' if len(name) == 1 else '--') + name
+                if len(name) > 1 and name in handler.options:
+                    word += '='
+                expected.add(word)
+        self.assertEqual(expected, set(re.findall("'([^']+)'", words)))
+        self.assertIn('complete -F _optmatch_my_tool my-tool', script)
+        self.assertIn('compdef _optmatch_my_tool my-tool',
+                      matcher.get_completion_script('my-tool', 'zsh'))
+        self.assertRaiseArg(OptionMatcherException, 'Unsupported shell: csh',
+                            matcher.get_completion_script, 'tool', 'csh')
+
+    @unittest.skipUnless(which('bash'), 'requires bash')
+    def test5012(self):
+        """Completion script: running the bash script"""
+
+        script = self.Simple().get_completion_script('tool')
+        script += ('COMP_WORDS=(tool --verbose --mo); COMP_CWORD=2; '
+                   '_optmatch_tool; echo "${COMPREPLY[@]}"')
+        output = subprocess.check_output(['bash', '-c', script])
+        self.assertEqual(b'--mode=', output.strip())
+
+
+class PlanTests(Tests):
+    """Tests on the OptionMatcher plan export"""
+
+    class Simple(OptionMatcher):
+
+        @optmatcher(flags='verbose', options='mode', int_options='level',
+                    multi_options='include', dict_prefixes='D',
+                    duplicates='collect', varargs='float', priority=2)
+        def handle(self, file, include, D, verbose=False, mode='fast',
+                   level=1, *rest):
+            '''Handles the file'''
+            return file, include, D, verbose, mode, level, rest
+
+        @optmatcher(flags='quiet', exclusive=True)
+        def handle_quiet(self):
+            return 'quiet'
+
+        @optset(applies='handle', count_flags='debug')
+        def set_debug(self, debug=0):
+            self.debug = debug
+
+    class Undecorated(OptionMatcher):
+
+        def handle(self, *args):
+            '''Handles the file'''
+            return 'plain', args
+
+        def handle_quiet(self):
+            return 'quiet'
+
+        def set_debug(self, debug=0):
+            self.debug = debug
+
+    def test5101(self):
+        """Exported plan is JSON compatible and complete"""
+
+        plan = json.loads(json.dumps(
+            self.Simple(aliases={'v': 'verbose'}).export_plan()))
+        self.assertEqual({'option': '--', 'assigner': '='}, plan['mode'])
+        self.assertEqual(['handle', 'handle_quiet'],
+                         [m['name'] for m in plan['matchers']])
+        handle = plan['matchers'][0]
+        self.assertEqual(2, handle['priority'])
+        self.assertFalse(handle['exclusive'])
+        self.assertTrue(plan['matchers'][1]['exclusive'])
+        self.assertEqual({'verbose': 4, 'v': 4}, handle['flags'])
+        self.assertEqual({'4': False, '5': 'fast', '6': 1},
+                         handle['defaults'])
+        self.assertEqual({'6': 'int'}, handle['converters'])
+        self.assertEqual('float', handle['vararg_converter']['convert'])
+        self.assertEqual('^(handle)$', plan['optsets'][0]['applies'])
+
+    def test5102(self):
+        """Loaded plan matches as the original, without inspection"""
+
+        plan = json.loads(json.dumps(self.Simple().export_plan()))
+        loaded = self.Undecorated().load_plan(plan)
+        self.assertEqual(('plain', ('f', ['a'], {'x': ['1', '2']}, True,
+                                    'slow', 3, 2.5)),
+                         loaded.process([None, '--include=a', '--verbose',
+                                         '-Dx=1', '--mode=slow', '--level=3',
+                                         '-Dx=2', '--debug', '--debug', 'f',
+                                         '2.5']))
+        self.assertEqual(2, loaded.debug)
+        self.assertEqual('quiet', loaded.process([None, '--quiet']))
+        self.assertEqual(self.Simple().get_usage().get_usage_string(),
+                         loaded.get_usage().get_usage_string())
+
+    def test5103(self):
+        """Plans with unsupported content"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(converters={'mode_option': lambda x: x})
+            def handle(self, mode_option, default=object()):
+                pass
+
+        self.assertRaiseArg(OptionMatcherException,
+                            'method Simple.handle: Cannot export default '
+                            'value of parameter default',
+                            Simple().export_plan)
+        self.assertRaiseArg(OptionMatcherException, 'Invalid plan',
+                            Simple().load_plan, {})
+        plan = self.Simple().export_plan()
+        plan['matchers'][0]['name'] = 'unknown'
+        self.assertRaiseArg(OptionMatcherException,
+                            'Unknown method in plan: unknown',
+                            self.Simple().load_plan, plan)
+
+    def test5105(self):
+        """Settings changed after loading a plan keep the plan"""
+
+        plan = self.Simple().export_plan()
+        loaded = self.Undecorated().load_plan(plan).enable_pooling()
+        self.assertEqual('quiet', loaded.process([None, '--quiet']))
+        loaded.enable_code_generation().enable_default_help(False)
+        self.assertEqual('quiet', loaded.process([None, '--quiet']))
+        self.assertRaiseArg(UsageException, 'Unexpected argument: --help',
+                            loaded.process, [None, '--help'],
+                            handle_usage_problems=False)
+        self.assertRaiseArg(OptionMatcherException,
+                            'Cannot set the aliases after load_plan',
+                            loaded.set_aliases, {'v': 'verbose'})
+        self.assertRaiseArg(OptionMatcherException,
+                            'Cannot set the mode after load_plan',
+                            loaded.set_mode, '/', ':')
+        self.assertRaiseArg(OptionMatcherException,
+                            'Cannot add matchers after load_plan',
+                            loaded.add_spec, {})
+
+    def test5104(self):
+        """Parse rejects loaded parameter names that cannot be slots"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher
+            def handle(self, file, other=None):
+                return file
+
+        plan = Simple().export_plan()
+        for name in ['self', '_self', 'class']:
+            plan['matchers'][0]['parameters'][0] = name
+            ret = Simple().load_plan(plan).parse([None, 'a'])
+            self.assertEqual({name: 'a', 'other': None}, ret.as_dict())
+        for name in ['file-name', '__file', '']:
+            plan['matchers'][0]['parameters'][0] = name
+            self.assertRaiseArg(OptionMatcherException,
+                                'method Simple.handle: Invalid parameter '
+                                'name: ' + name,
+                                Simple().load_plan(plan).parse, [None, 'a'])
+        plan['matchers'][0]['parameters'][0] = 'other'
+        self.assertRaiseArg(OptionMatcherException,
+                            'method Simple.handle: Duplicated parameter names',
+                            Simple().load_plan(plan).parse, [None, 'a'])
+
+
+class ServerTests(Tests):
+    """Tests on the OptionMatcher server mode"""
+
+    class Simple(OptionMatcher):
+
+        def __init__(self):
+            OptionMatcher.__init__(self)
+            self.calls = 0
+
+        @optmatcher
+        def handle(self, name, fail_flag=False):
+            self.calls += 1
+            print(os.path.expandvars('hello $OPTMATCH_NAME ' + name))
+            print(os.getcwd())
+            return 3 if fail_flag else None
+
+    def test5201(self):
+        """Captured processing"""
+
+        matcher = self.Simple()
+        self.assertEqual((0, 'hello you a\n/\n', ''),
+                         matcher.process_captured([None, 'a'],
+                                                  {'OPTMATCH_NAME': 'you'},
+                                                  '/'))
+        self.assertNotIn('OPTMATCH_NAME', os.environ)
+        self.assertEqual(3, matcher.process_captured(['a', '--fail', 'b'])[0])
+        self.assertEqual((2, '', 'Unexpected argument: c\n'),
+                         matcher.process_captured([None, 'b', 'c']))
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires unix sockets')
+    def test5202(self):
+        """Server and client over a unix socket"""
+
+        matcher = self.Simple()
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, 'socket')
+        server = matcher.create_server(path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            for i in range(3):
+                status, out, err = call_server(path, [None, str(i)],
+                                               {'OPTMATCH_NAME': 'me'}, '/')
+                self.assertEqual((0, 'hello me %d\n/\n' % i, ''),
+                                 (status, out, err))
+            self.assertEqual(2, call_server(path, [None])[0])
+            self.assertEqual(3, matcher.calls)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertFalse(os.path.exists(path))
+        os.rmdir(folder)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork'),
+                         'requires unix sockets and fork')
+    def test5203(self):
+        """Fork server: each request on a new process"""
+
+        class Simple(OptionMatcher):
+
+            @optmatcher
+            def handle(self):
+                self.calls = getattr(self, 'calls', 0) + 1
+                print('%d %d' % (os.getpid(), self.calls))
+
+        matcher = Simple()
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, 'socket')
+        server = matcher.create_server(path, fork=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            outputs = [call_server(path, [None])[1] for _ in range(3)]
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+        os.rmdir(folder)
+        pids = set()
+        for each in outputs:
+            pid, calls = each.split()
+            self.assertEqual('1', calls)
+            pids.add(int(pid))
+        self.assertEqual(3, len(pids))
+        self.assertNotIn(os.getpid(), pids)
+        self.assertFalse(hasattr(matcher, 'calls'))
+
+
+class ReplTests(Tests):
+    """Tests on the OptionMatcher interactive mode"""
+
+    class Simple(OptionMatcher):
+
+        def __init__(self):
+            OptionMatcher.__init__(self)
+            self.received = []
+
+        @optmatcher
+        def handle(self, name, verbose_flag=False):
+            self.received.append((name, verbose_flag))
+
+    def test5301(self):
+        """Lines are split as shell arguments, errors do not stop"""
+
+        matcher, err = self.Simple(), sys.stderr
+        sys.stderr = StringIO()
+        try:
+            matcher.repl(stream=StringIO('a\n\n--verbose "b c"\n'
+                                         'a b\n"open\nd\n'))
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = err
+        self.assertEqual([('a', False), ('b c', True), ('d', False)],
+                         matcher.received)
+        self.assertEqual('Unexpected argument: b\nNo closing quotation\n',
+                         errors)
+
+    def test5302(self):
+        """Readline completer"""
+
+        class Readline(object):
+            def get_line_buffer(self):
+                return 'name --v'
+
+            def get_begidx(self):
+                return 5
+
+        completer = self.Simple()._get_completer('tool', Readline(), False)
+        self.assertEqual(['--verbose', None],
+                         [completer('--v', 0), completer('--v', 1)])
+
+
+class ScriptTests(Tests):
+    """Tests on the OptionMatcher script runner"""
+
+    SCRIPT = ('first\n# comment\n\n"second one"\n'
+              'a b c\nthird --twice\n')
+
+    class Simple(OptionMatcher):
+
+        @optmatcher
+        def handle(self, name, twice_flag=False):
+            print(name)
+            if twice_flag:
+                print(name)
+                return 5
+
+    def run_script(self, **kwargs):
+        out, err = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            status = self.Simple().run_script(StringIO(self.SCRIPT), 'tool',
+                                              **kwargs)
+            return status, sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = out, err
+
+    def test5401(self):
+        """Scripts stop on usage problems, unless keep_going"""
+
+        self.assertEqual((2, 'first\nsecond one\n',
+                          'Unexpected argument: b\n'), self.run_script())
+        self.assertEqual((2, 'first\nsecond one\nthird\nthird\n',
+                          'Unexpected argument: b\n'),
+                         self.run_script(keep_going=True))
+
+    def test5402(self):
+        """Scripts with JSON output"""
+
+        output = StringIO()
+        self.assertEqual((2, '', ''),
+                         self.run_script(keep_going=True, json_output=output))
+        lines = [json.loads(x) for x in output.getvalue().splitlines()]
+        self.assertEqual([1, 4, 5, 6], [x['line'] for x in lines])
+        self.assertEqual([0, 0, 2, 5], [x['status'] for x in lines])
+        self.assertEqual({'line': 6, 'args': ['third', '--twice'],
+                          'status': 5, 'stdout': 'third\nthird\n',
+                          'stderr': ''}, lines[-1])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test5403(self):
+        """Scripts processed by parallel workers keep the order"""
+
+        self.SCRIPT = ''.join(['line%d\n' % i for i in range(2000)])
+        self.assertEqual((0, self.SCRIPT, ''), self.run_script(workers=3))
+
+
+class LazyTests(Tests):
+    """Tests on lazy matchers"""
+
+    MODULE = '''
+def remove(file, force=False):
+    """Removes the file"""
+    return 'removed', file, force
+'''
+
+    class Simple(OptionMatcher):
+
+        @optmatcher
+        def handle(self, file, copy_flag):
+            return 'copied', file
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.module = 'optmatch_lazy_%d' % id(self)
+        with open(os.path.join(self.folder, self.module + '.py'), 'w') as f:
+            f.write(self.MODULE)
+        sys.path.insert(0, self.folder)
+
+    def tearDown(self):
+        sys.path.remove(self.folder)
+        sys.modules.pop(self.module, None)
+        for each in os.listdir(self.folder):
+            if each.endswith('.py'):
+                os.remove(os.path.join(self.folder, each))
+
+    def test5501(self):
+        """Lazy matchers are imported only when selected"""
+
+        matcher = self.Simple().add_lazy_matcher(
+            self.module + ':remove', 'file, force=False', flags='force')
+        self.assertEqual(('copied', 'a'),
+                         matcher.process([None, '--copy', 'a']))
+        self.assertNotIn(self.module, sys.modules)
+        self.assertEqual(('removed', 'a', True),
+                         matcher.process([None, '--force', 'a']))
+        self.assertIn(self.module, sys.modules)
+
+    def test5502(self):
+        """Lazy matchers from plan entries, and help requests"""
+
+        plan = self.Simple().add_lazy_matcher(
+            self.module + '.remove', 'file, force_flag=False',
+            priority=1).export_plan()
+        self.assertEqual(['remove', 'handle'],
+                         [x['name'] for x in plan['matchers']])
+        matcher = self.Simple().add_lazy_matcher(
+            self.module + ':remove', plan_entry=plan['matchers'][0])
+        self.assertEqual(('removed', 'b', False),
+                         matcher.process([None, 'b']))
+        sys.modules.pop(self.module)
+        loaded = self.Simple().load_plan(plan)
+        self.assertNotIn(self.module, sys.modules)
+        self.assertIn('Removes the file',
+                      loaded.get_usage().get_usage_string())
+        self.assertIn(self.module, sys.modules)
+
+    def test5503(self):
+        """Lazy matchers errors"""
+
+        self.assertRaiseArg(OptionMatcherException,
+                            'Invalid signature for a.b: file,,',
+                            self.Simple().add_lazy_matcher, 'a.b', 'file,,')
+        matcher = self.Simple().add_lazy_matcher(self.module + ':other',
+                                                 'file')
+        self.assertRaiseArg(OptionMatcherException,
+                            'Cannot load ' + self.module + ':other',
+                            matcher.process, [None, 'file'])
+
+    def test5504(self):
+        """Spec matchers on plans, found by their target"""
+
+        spec = {'matchers': [{'name': 'delete', 'flags': 'force',
+                              'parameters': 'file, force',
+                              'defaults': {'force': False},
+                              'target': self.module + ':remove'}]}
+        plan = OptionMatcher().add_spec(spec).export_plan()
+        self.assertEqual(self.module + ':remove',
+                         plan['matchers'][0]['target'])
+        loaded = OptionMatcher().load_plan(plan)
+        self.assertEqual(('removed', 'a', True),
+                         loaded.process([None, '--force', 'a']))
+        self.assertEqual('delete', type(loaded.parse([None, 'a'])).__name__)
+        del spec['matchers'][0]['target']
+        self.assertRaiseArg(OptionMatcherException,
+                            'function delete: Cannot export a spec matcher '
+                            'without target',
+                            OptionMatcher().add_spec(spec).export_plan)
+
+
+class SubcommandTests(Tests):
+    """Tests on nested subcommands"""
+
+    class Git(OptionMatcher):
+
+        @optmatcher(command='remote add')
+        def add(self, name, url, tags_flag=False):
+            return 'add', name, url, tags_flag
+
+        @optmatcher(command=['remote', 'remove'])
+        def remove(self, name):
+            return 'remove', name
+
+        @optmatcher(command='remote')
+        def remote(self, verbose_flag=False):
+            return 'remote', verbose_flag
+
+        @optmatcher
+        def handle(self, path):
+            return 'path', path
+
+    def test5601(self):
+        """Subcommands are dispatched on the leading command words"""
+
+        git = self.Git()
+        self.assertEqual(('add', 'origin', 'url', True),
+                         git.process([None, 'remote', 'add', '--tags',
+                                      'origin', 'url']))
+        self.assertEqual(('remove', 'origin'),
+                         git.process([None, 'remote', 'remove', 'origin']))
+        self.assertEqual(('remote', True),
+                         git.process([None, 'remote', '--verbose']))
+        self.assertEqual(('remote', False), git.process([None, 'remote']))
+        self.assertEqual(('path', 'add'), git.process([None, 'add']))
+        self.assertRaiseArg(UsageException, 'Unexpected argument: origin',
+                            git.process, [None, 'remote', 'origin'],
+                            handle_usage_problems=False)
+
+    def test5602(self):
+        """Subcommands on completion, usage and plans"""
+
+        git = self.Git()
+        self.assertEqual(['add', 'remove'],
+                         git.complete([None, 'remote', ''])[-2:])
+        self.assertEqual(['remove'], git.complete([None, 'remote', 're']))
+        self.assertEqual(['--tags'],
+                         git.complete([None, 'remote', 'add', '--t']))
+        usage = git.get_usage().get_usage_string()
+        self.assertIn('Usage: command [common options]', usage)
+        self.assertIn('* remote add [--tags (False)] name url', usage)
+        loaded = self.Git().load_plan(git.export_plan())
+        self.assertEqual(('remove', 'x'),
+                         loaded.process([None, 'remote', 'remove', 'x']))
+        status, out, _ = git.process_captured([None, 'remote', 'add',
+                                               '--help'])
+        self.assertEqual((0, usage + '\n'), (status, out))
+
+    def test5603(self):
+        """Invalid subcommands"""
+
+        class Invalid(OptionMatcher):
+            @optmatcher(command='remote --add')
+            def handle(self, name):
+                pass
+
+        self.assertRaiseArg(OptionMatcherException,
+                            'method Invalid.handle: Invalid command: --add',
+                            Invalid().process, [None, 'remote'])
+
+    @unittest.skipUnless(which('bash'), 'requires bash')
+    def test5604(self):
+        """Subcommands on completion scripts"""
+
+        def complete(*words):
+            script = self.Git().get_completion_script('git')
+            script += ('COMP_WORDS=(git %s); COMP_CWORD=%d; _optmatch_git; '
+                       'echo "${COMPREPLY[@]}"' %
+                       (' '.join(["'%s'" % w for w in words]), len(words)))
+            folder = tempfile.mkdtemp()  # no files to complete
+            try:
+                return subprocess.check_output(['bash', '-c', script],
+                                               cwd=folder).split()
+            finally:
+                os.rmdir(folder)
+
+        self.assertEqual([b'remote'], complete('re'))
+        self.assertEqual([b'add', b'remove'], complete('remote', ''))
+        self.assertEqual([b'add'], complete('remote', 'a'))
+        self.assertEqual([], complete('remote', 'add', ''))
+        self.assertEqual([b'--tags'], complete('remote', '--t'))
+        self.assertIn("commands=('remote' 'remote add' 'remote remove')",
+                      self.Git().get_completion_script('git', 'zsh'))
+
+
+class GeneratedParserTests(Tests):
+    """Differential tests between the generic and the generated parsers"""
+
+    class Tool(OptionMatcher):
+
+        @optset(flags='quiet')
+        def set_quiet(self, level_option_int=0):
+            self.level = level_option_int
+
+        @optmatcher(count_flags='verbose', multi_options='include',
+                    converters={'sizes': 'int_list'},
+                    dict_prefixes='define', raw_options='pattern',
+                    options='sizes, output')
+        def compile(self, file, verbose=0, include=None, sizes=None,
+                    define=None, pattern=None, output='a.out'):
+            return ('compile', file, verbose, include, sizes and list(sizes),
+                    define, pattern, output)
+
+        @optmatcher(priority=1)
+        def copy(self, source, target, force_flag, mode_option_float=0.5,
+                 attrPrefix=None):
+            return 'copy', source, target, force_flag, mode_option_float, \
+                attrPrefix
+
+        @optmatcher
+        def run(self, command, *args, **kwargs):
+            return 'run', command, args, kwargs
+
+    ARGS = [[], ['a'], ['a', 'b'], ['a', 'b', 'c'], ['--force', 'a', 'b'],
+            ['-f', 'a', 'b'], ['--force=1', 'a', 'b'], ['-v', 'x'],
+            ['-vvv', 'x'], ['-v', '-v', '--verbose', 'x'],
+            ['--include=a', '--include', 'b', 'x'], ['-ia', '-i', 'b', 'x'],
+            ['--sizes=1,2', 'x'], ['--sizes=1,a', 'x'], ['-s', '3', 'x'],
+            ['-Da=1', '-D', 'b=2', '-Da=3', 'x'], ['--definea=1', 'x'],
+            ['--define', 'a=1', 'x'], ['--define=a=1', 'x'],
+            ['--pattern=$HOME', 'x'], ['--output=$HOME', 'x'],
+            ['-o'], ['-o', 'out', 'x'], ['--output'], ['--quiet', 'x'],
+            ['-q', '-l', '2', 'x'], ['--level=a', 'x'], ['-ql2', 'x'],
+            ['--mode=2', '-f', 'a', 'b'], ['--attrx=1', '-f', 'a', 'b'],
+            ['-a', 'x=1', '-f', 'a', 'b'], ['-a'], ['--attr', 'x', 'a'],
+            ['--other=1', 'a'], ['-z', 'a'], ['-vz', 'a'], ['--', 'a'],
+            ['-', 'a'], ['-fa', 'b']]
+
+    def outcome(self, matcher, args, gnu):
+        try:
+            return matcher.process([None] + args, gnu,
+                                   handle_usage_problems=False)
+        except Exception as ex:
+            return type(ex), str(ex)
+
+    def check(self, mode):
+        generic = self.Tool(aliases={'v': 'verbose', 'i': 'include',
+                                     's': 'sizes', 'D': 'define',
+                                     'o': 'output', 'f': 'force',
+                                     'l': 'level', 'q': 'quiet',
+                                     'a': 'attr'})
+        generated = self.Tool(aliases=generic._aliases.copy())
+        generated.enable_code_generation()
+        if mode:
+            generic.set_mode(*mode)
+            generated.set_mode(*mode)
+        kinds = set()
+        for args in self.ARGS:
+            if mode:
+                args = [a.replace('--', mode[0], 1) for a in args]
+            for gnu in False, True:
+                outcome = self.outcome(generic, args, gnu)
+                self.assertEqual(outcome, self.outcome(generated, args, gnu),
+                                 args)
+                kinds.add(outcome[0])
+        self.assertEqual(set(['compile', 'copy', 'run', UsageException]),
+                         kinds)
+
+    def test5701(self):
+        """Generated parsers behave as the generic ones, in getopt mode"""
+        self.check(None)
+
+    def test5702(self):
+        """Generated parsers behave as the generic ones, in other modes"""
+        self.check(('-', '='))
+        self.check(('/', ':'))
+
+    def test5703(self):
+        """Generated parsers are compiled once"""
+
+        def get_handler():
+            matcher = self.Tool().enable_code_generation()
+            return matcher._get_plan().matchers[0]
+
+        handler = get_handler()
+        self.assertIn("name == 'force'", handler.get_parser_source()[0])
+        self.assertIs(handler.handle_arg.__func__.__code__,
+                      get_handler().handle_arg.__func__.__code__)
+
+
 class UsageTests(Tests):
     """Tests on internal OptMatcherHandler"""
 
@@ -2295,6 +3791,25 @@ class BugTests(Tests):
 
         self.assertTrue(Simple().process([None, '--dry_run']))
 
+    def test_bug00003(self):
+        """decorated flags, options and prefixes are also taken as
+           positional parameters, receiving the extra arguments
+        """
+
+        class Simple(OptionMatcher):
+
+            @optmatcher(flags='verbose')
+            def handle(self, file, verbose=False): return file, verbose
+
+        self.assertEqual(('a', True), Simple().process([None, 'a',
+                                                        '--verbose']))
+        self.assertRaiseArg(UsageException, 'Unexpected argument: b',
+                            Simple().process, [None, 'a', 'b'],
+                            handle_usage_problems=False)
+        self.assertEqual('Usage: [common options] file',
+                         Simple().get_usage().get_usage_string()
+                         .splitlines()[0])
+
 
 if __name__ == '__main__':
     unittest.main()